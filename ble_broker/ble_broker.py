@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+
+# Owns the bluetooth adapters, and runs the scans and the GATT connections of all the
+# collectors (ble_watch, lywsd03mmc_watcher, inkbird...), so that they no longer collide
+# with "Operation already in progress".
+#
+# The collectors talk to it over a unix socket, see broker_client.py: one JSON request per
+# line, answered by one JSON line once the request went through a radio.
+#
+# The requests wait in a priority queue (lowest value first), shared by one radio thread
+# per adapter. An idle radio takes the most urgent request it is the best placed for: GATT
+# connections go to the adapter hearing the device the loudest, unless it is busy, so the
+# connections run on one adapter while the scans continue on another. The queued scans are
+# merged into a single scan window, which also admits the scans arriving while it runs, as
+# long as no GATT request waits for this radio.
+#
+# An adapter failing several requests in a row with adapter errors (not a device out of range)
+# is reset and left aside for a while, and its requests are retried on the other adapters.
+
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import os
+import socketserver
+import subprocess
+import threading
+import time
+
+from bluepy import btle
+from prometheus_client import start_http_server, Counter, Gauge, Histogram
+
+logging.basicConfig(
+    format='%(asctime)s.%(msecs)03d %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    handlers=[logging.StreamHandler()],
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+DEFAULT_SOCKET = "/run/ble_broker.sock"
+
+OP_SCAN = "scan"
+OP_GATT = "gatt"
+
+# Default priorities: GATT connections are short and their devices only listen for a moment
+# after they advertised, so they go first.
+PRIORITIES = {
+    OP_GATT: 10,
+    OP_SCAN: 20,
+}
+
+MAX_SCAN_DURATION = 60
+# How often a running scan checks which requests are done
+SCAN_SLICE = 0.1
+DEFAULT_NOTIFY_TIMEOUT = 15.0
+# Rough bound of a GATT connection and its reads and writes, notifications aside
+GATT_TIMEOUT = 30
+# How long a request may wait for an adapter, on top of its radio time, before its client gets an error
+QUEUE_TIMEOUT = 300
+
+# Consecutive adapter errors after which an adapter is considered wedged
+WEDGED_FAILURES = 3
+# The errors of the adapter itself, rather than of the device a request is for: management
+# commands refused, and bluepy helper process dead or confused (broken pipe writing to it)
+ADAPTER_ERRORS = (btle.BTLEManagementError, btle.BTLEInternalError, OSError)
+# How long a wedged adapter is left aside after its reset
+WEDGED_COOLDOWN = 30
+# How many adapters a request is tried on
+MAX_ATTEMPTS = 2
+# Weight of the last advert in the RSSI average of a device
+RSSI_SMOOTHING = 0.3
+
+CCCD_UUID = 0x2902
+CCCD_NOTIFY = b"\x01\x00"
+
+RADIO_TIME = Counter('ble_broker_radio_seconds', 'Time the adapters worked on the requests of each client', ['client', 'op'])
+REQUESTS = Counter('ble_broker_requests', 'Requests handled by the broker', ['client', 'op', 'result'])
+QUEUE_WAIT = Histogram('ble_broker_queue_wait_seconds', 'Time the requests waited for an adapter', ['op'],
+                       buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+QUEUE_DEPTH = Gauge('ble_broker_queue_depth', 'Requests waiting for an adapter')
+ADAPTER_BUSY = Counter('ble_broker_adapter_busy_seconds', 'Time each adapter spent on requests', ['iface'])
+ADAPTER_UP = Gauge('ble_broker_adapter_up', 'Whether the adapter takes requests (0 while wedged)', ['iface'])
+ADAPTER_RESETS = Counter('ble_broker_adapter_resets', 'Resets of the wedged adapters', ['iface'])
+
+
+class Job:
+    """A client request, waiting for or running on a radio"""
+
+    def __init__(self, client, op, params, priority=None):
+        if op not in PRIORITIES:
+            raise ValueError(f"unknown operation {op!r}")
+        self.client = client
+        self.op = op
+        self.params = params
+        self.priority = PRIORITIES[op] if priority is None else priority
+        self.queued = time.monotonic()
+        self.started = None
+        self.waited = 0
+        self.radio_time = 0
+        self.tried = set()  # interfaces this request failed on
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def __repr__(self):
+        return f"Job({self.client}, {self.op}, priority={self.priority})"
+
+    def radio_timeout(self):
+        """Longest the request should take on a radio"""
+        return GATT_TIMEOUT + sum(float(action.get("timeout", DEFAULT_NOTIFY_TIMEOUT))
+                                  for action in self.params.get("actions", ()) if action.get("op") == "notify")
+
+    @property
+    def timeout(self):
+        """How long its client waits for the request, in the queue and on all its attempts"""
+        return QUEUE_TIMEOUT + MAX_ATTEMPTS * self.radio_timeout()
+
+    def start(self):
+        self.started = time.monotonic()
+        self.waited += self.started - self.queued
+        QUEUE_WAIT.labels(self.op).observe(self.started - self.queued)
+
+    def _charge(self):
+        if self.started is not None:
+            elapsed = time.monotonic() - self.started
+            self.radio_time += elapsed
+            RADIO_TIME.labels(self.client, self.op).inc(elapsed)
+            self.started = None
+
+    def requeue(self, iface):
+        """Back to the queue, after a failure on iface"""
+        self._charge()
+        self.tried.add(iface)
+        self.queued = time.monotonic()
+
+    def finish(self, result=None, error=None):
+        if self.done.is_set():
+            return
+        self._charge()
+        self.result = result
+        self.error = error
+        REQUESTS.labels(self.client, self.op, "error" if error else "ok").inc()
+        self.done.set()
+
+    def response(self):
+        if self.error:
+            return dict(ok=False, error=self.error)
+        return dict(ok=True, result=self.result, queued=round(self.waited, 3), radio=round(self.radio_time, 3))
+
+
+class ScanJob(Job):
+    """Scan request: collects the latest advert of every (target) device"""
+
+    def __init__(self, client, params, priority=None):
+        super().__init__(client, OP_SCAN, params, priority)
+        self.targets = {mac.lower() for mac in params.get("targets", ())}
+        self.adtype = params.get("adtype")
+        self.passive = bool(params.get("passive", False))
+        self.duration = min(float(params.get("duration", 10)), MAX_SCAN_DURATION)
+        self.adverts = {}
+        self.deadline = None
+
+    def start(self):
+        super().start()
+        # A retried scan only gets the rest of its duration
+        self.deadline = self.started + max(self.duration - self.radio_time, SCAN_SLICE)
+
+    def radio_timeout(self):
+        return self.duration
+
+    def seen(self, dev, iface):
+        if self.targets and dev.addr not in self.targets:
+            return
+        if self.adtype is not None and self.adtype not in dev.scanData:
+            return
+        self.adverts[dev.addr] = dict(
+            addr=dev.addr,
+            addrType=dev.addrType,
+            rssi=dev.rssi,
+            scanData={str(adtype): value.hex() for adtype, value in dev.scanData.items()},
+            time=time.time(),
+            iface=iface,
+        )
+
+    def complete(self):
+        return bool(self.targets) and self.targets.issubset(self.adverts)
+
+    def finish(self, result=None, error=None):
+        if result is None and error is None:
+            result = dict(adverts=list(self.adverts.values()))
+        super().finish(result, error)
+
+
+class Scheduler:
+    """The queue of the requests, shared by the radios of all the adapters"""
+
+    def __init__(self):
+        self.radios = []
+        self._queue = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._rssi = {}  # addr -> {iface: smoothed RSSI}
+
+    def submit(self, job):
+        with self._cond:
+            heapq.heappush(self._queue, (job.priority, next(self._sequence), job))
+            QUEUE_DEPTH.set(len(self._queue))
+            self._cond.notify_all()
+
+    def cancel(self, job):
+        """Removes a request from the queue, if it is still there"""
+        with self._cond:
+            self._remove([item for item in self._queue if item[2] is job])
+            QUEUE_DEPTH.set(len(self._queue))
+
+    def observe(self, iface, addr, rssi):
+        """Called for every advert, to learn which adapter hears each device the best"""
+        with self._cond:
+            levels = self._rssi.setdefault(addr, {})
+            previous = levels.get(iface)
+            levels[iface] = rssi if previous is None else previous + RSSI_SMOOTHING * (rssi - previous)
+
+    def preferred(self, job):
+        """The healthy radio hearing the device of a GATT request the loudest, or None if unknown"""
+        if job.op != OP_GATT:
+            return None
+        levels = self._rssi.get(job.params["mac"].lower(), {})
+        candidates = [radio for radio in self.radios
+                      if radio.healthy and radio.iface not in job.tried and radio.iface in levels]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda radio: levels[radio.iface])
+
+    def _fits(self, job, radio):
+        if radio.iface in job.tried and any(other.healthy and other.iface not in job.tried
+                                            for other in self.radios if other is not radio):
+            return False
+        best = self.preferred(job)
+        # The best placed adapter is busy: better to connect now from another one
+        return best is None or best is radio or best.busy
+
+    def take(self, radio):
+        """Blocks until there is a request for radio, and returns it along with the queued scans if it is a scan"""
+        with self._cond:
+            while True:
+                if radio.healthy:
+                    for item in sorted(self._queue):
+                        if self._fits(item[2], radio):
+                            self._remove([item])
+                            jobs = [item[2]]
+                            if item[2].op == OP_SCAN:
+                                jobs += self._takeScans(passive=None)
+                            radio.busy = True
+                            QUEUE_DEPTH.set(len(self._queue))
+                            return jobs
+                # Also wakes up a wedged radio once its cooldown is over
+                self._cond.wait(1)
+
+    def release(self, radio):
+        with self._cond:
+            radio.busy = False
+            self._cond.notify_all()
+
+    def _remove(self, items):
+        self._queue = [item for item in self._queue if item not in items]
+        heapq.heapify(self._queue)
+
+    def _takeScans(self, passive):
+        """Removes the queued scans compatible with a scan window (passive: None for any) from the queue"""
+        taken = [item for item in self._queue
+                 if item[2].op == OP_SCAN and (passive is None or not passive or item[2].passive)]
+        if taken:
+            self._remove(taken)
+        return [item[2] for item in sorted(taken)]
+
+    def joiningScans(self, radio, passive):
+        """The scans which can join the running window of radio: none while a GATT request waits for it"""
+        with self._cond:
+            idle = [other for other in self.radios if other is not radio and other.healthy and not other.busy]
+            if not idle and any(item[2].op != OP_SCAN for item in self._queue):
+                return []
+            jobs = self._takeScans(passive)
+            QUEUE_DEPTH.set(len(self._queue))
+        return jobs
+
+    def retry(self, job, radio):
+        """Queues again a request which failed on radio, if another adapter can take it"""
+        job.requeue(radio.iface)
+        if len(job.tried) >= MAX_ATTEMPTS or not any(other.healthy and other.iface not in job.tried
+                                                     for other in self.radios):
+            return False
+        logging.info(f"{job} failed on hci{radio.iface}, retrying on another adapter")
+        self.submit(job)
+        return True
+
+
+class _ScanDelegate(btle.DefaultDelegate):
+
+    def __init__(self, scheduler, iface):
+        btle.DefaultDelegate.__init__(self)
+        self.scheduler = scheduler
+        self.iface = iface
+        self.jobs = []
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        self.scheduler.observe(self.iface, dev.addr, dev.rssi)
+        for job in self.jobs:
+            job.seen(dev, self.iface)
+
+
+class _NotificationDelegate(btle.DefaultDelegate):
+
+    def __init__(self):
+        btle.DefaultDelegate.__init__(self)
+        self.handle = None
+        self.values = []
+
+    def listen(self, handle):
+        self.handle = handle
+        self.values = []
+
+    def handleNotification(self, cHandle, data):
+        if cHandle == self.handle:
+            self.values.append(data)
+
+
+class Radio(threading.Thread):
+    """The only thread using an adapter: runs one scan window or GATT connection at a time"""
+
+    def __init__(self, scheduler, iface=0):
+        threading.Thread.__init__(self, name=f"radio-hci{iface}", daemon=True)
+        self.scheduler = scheduler
+        self.iface = iface
+        self.busy = False
+        self.failures = 0
+        self.wedged_until = 0
+        ADAPTER_UP.labels(iface).set(1)
+        scheduler.radios.append(self)
+
+    def __repr__(self):
+        return f"Radio(hci{self.iface})"
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.wedged_until
+
+    def run(self):
+        while True:
+            jobs = self.scheduler.take(self)
+            ADAPTER_UP.labels(self.iface).set(1)
+            started = time.monotonic()
+            try:
+                if jobs[0].op == OP_SCAN:
+                    self._scan(jobs)
+                else:
+                    self._gatt(jobs[0])
+                self.failures = 0
+            except ADAPTER_ERRORS as e:
+                logging.error(f"hci{self.iface} {jobs}: {e.__class__.__name__}: {e}")
+                self.failures += 1
+                if self.failures >= WEDGED_FAILURES:
+                    self._reset()
+                self._failed(jobs, e)
+            except Exception as e:
+                # Device out of range, disconnected, missing characteristic...: not the adapter's fault
+                logging.warning(f"hci{self.iface} {jobs}: {e.__class__.__name__}: {e}")
+                self._failed(jobs, e)
+            finally:
+                ADAPTER_BUSY.labels(self.iface).inc(time.monotonic() - started)
+                self.scheduler.release(self)
+
+    def _failed(self, jobs, e):
+        for job in jobs:
+            if not job.done.is_set() and not self.scheduler.retry(job, self):
+                job.finish(error=f"{e.__class__.__name__}: {e}")
+
+    def _reset(self):
+        logging.warning(f"hci{self.iface} failed {self.failures} requests in a row, resetting it")
+        ADAPTER_RESETS.labels(self.iface).inc()
+        ADAPTER_UP.labels(self.iface).set(0)
+        self.failures = 0
+        self.wedged_until = time.monotonic() + WEDGED_COOLDOWN
+        try:
+            subprocess.run(["hciconfig", f"hci{self.iface}", "reset"], timeout=10, check=True)
+        except (OSError, subprocess.SubprocessError) as e:
+            logging.error(f"hci{self.iface} reset failed: {e}")
+
+    def _scan(self, jobs):
+        # A passive window only if nobody asked for the scan responses
+        passive = all(job.passive for job in jobs)
+        delegate = _ScanDelegate(self.scheduler, self.iface)
+        for job in jobs:
+            job.start()
+        delegate.jobs = list(jobs)
+
+        logging.info(f"hci{self.iface} scan window ({'passive' if passive else 'active'}) for {jobs}")
+        scanner = btle.Scanner(self.iface).withDelegate(delegate)
+        scanner.start(passive=passive)
+        try:
+            while delegate.jobs:
+                scanner.process(SCAN_SLICE)
+                now = time.monotonic()
+                for job in list(delegate.jobs):
+                    if job.complete() or now >= job.deadline:
+                        delegate.jobs.remove(job)
+                        job.finish()
+                for job in self.scheduler.joiningScans(self, passive):
+                    job.start()
+                    delegate.jobs.append(job)
+        except BaseException:
+            # Only the requests still running, the joined ones too, are retried elsewhere
+            del jobs[:]
+            jobs.extend(delegate.jobs)
+            raise
+        finally:
+            try:
+                scanner.stop()
+            except btle.BTLEException:
+                pass
+
+    def _gatt(self, job):
+        job.start()
+        mac = job.params["mac"]
+        logging.info(f"hci{self.iface} GATT connection to {mac} for {job}")
+        delegate = _NotificationDelegate()
+        peripheral = btle.Peripheral()
+        peripheral.setDelegate(delegate)
+        peripheral.connect(mac, job.params.get("addrType", btle.ADDR_TYPE_PUBLIC), iface=self.iface)
+        try:
+            results = [self._action(peripheral, delegate, action) for action in job.params.get("actions", ())]
+        finally:
+            peripheral.disconnect()
+        job.finish(dict(results=results))
+
+    def _action(self, peripheral, delegate, action):
+        kind = action.get("op")
+        ch = peripheral.getCharacteristics(uuid=action["uuid"])[0]
+        if kind == "read":
+            return ch.read().hex()
+        if kind == "write":
+            ch.write(bytes.fromhex(action["value"]), withResponse=True)
+            return None
+        if kind == "notify":
+            # count == 0: until the device stops notifying for timeout seconds
+            count = int(action.get("count", 1))
+            timeout = float(action.get("timeout", DEFAULT_NOTIFY_TIMEOUT))
+            delegate.listen(ch.getHandle())
+            ch.getDescriptors(forUUID=CCCD_UUID)[0].write(CCCD_NOTIFY, withResponse=True)
+            while count == 0 or len(delegate.values) < count:
+                if not peripheral.waitForNotifications(timeout):
+                    break
+            return [value.hex() for value in delegate.values]
+        raise ValueError(f"unknown GATT action {kind!r}")
+
+
+def make_job(request):
+    client = str(request.get("client", "unknown"))
+    op = request.get("op")
+    params = request.get("params", {})
+    priority = request.get("priority")
+    if op == OP_SCAN:
+        return ScanJob(client, params, priority)
+    if op == OP_GATT and "mac" not in params:
+        raise ValueError("GATT request without mac")
+    return Job(client, op, params, priority)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = make_job(json.loads(line))
+            except (ValueError, TypeError, AttributeError) as e:
+                response = dict(ok=False, error=f"bad request: {e}")
+            else:
+                self.server.scheduler.submit(job)
+                if not job.done.wait(job.timeout):
+                    self.server.scheduler.cancel(job)
+                    logging.error(f"{job} not done after {job.timeout:.0f}s, giving up")
+                    job.finish(error=f"timed out after {job.timeout:.0f}s")
+                response = job.response()
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, scheduler):
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, RequestHandler)
+        os.chmod(path, 0o660)
+        self.scheduler = scheduler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bluetooth adapter broker for the BLE collectors")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help=f"Unix socket of the broker [default: {DEFAULT_SOCKET}]")
+    parser.add_argument("--iface", type=int, action="append",
+                        help="Index of an hci adapter to use, can be repeated [default: 0]")
+    parser.add_argument("-b", "--bind", metavar='ADDRESS', default='0.0.0.0', help="Specify alternate bind address [default: 0.0.0.0]")
+    parser.add_argument("-p", "--port", metavar='PORT', default=0, type=int, help="Port of the Prometheus metrics, 0 to disable [default: 0]")
+    args = parser.parse_args()
+
+    if args.port:
+        start_http_server(addr=args.bind, port=args.port)
+        logging.info("Listening on http://{}:{}".format(args.bind, args.port))
+
+    scheduler = Scheduler()
+    for iface in args.iface or [0]:
+        Radio(scheduler, iface).start()
+
+    with BrokerServer(args.socket, scheduler) as server:
+        logging.info(f"Broker listening on {args.socket} for {scheduler.radios}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(args.socket)
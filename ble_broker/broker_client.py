@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+# Client side of ble_broker.py, for the collectors which share the bluetooth adapter.
+# Only depends on the standard library, so that it can be imported next to bleak or bluepy.
+
+import json
+import os
+import socket
+
+DEFAULT_SOCKET = os.getenv("BLE_BROKER", "/run/ble_broker.sock")
+
+COMPLETE_LOCAL_NAME = 0x09
+SHORT_LOCAL_NAME = 0x08
+SERVICE_DATA_16B = 0x16
+MANUFACTURER = 0xFF
+
+
+class BrokerError(Exception):
+    pass
+
+
+class Advert:
+    """An advert relayed by the broker, with the fields of bluepy's ScanEntry the collectors use"""
+
+    __slots__ = ("addr", "addrType", "rssi", "scanData", "time", "iface")
+
+    def __init__(self, addr, addrType, rssi, scanData, time, iface=None):
+        self.addr = addr
+        self.addrType = addrType
+        self.rssi = rssi
+        self.scanData = {int(adtype): bytes.fromhex(value) for adtype, value in scanData.items()}
+        self.time = time
+        # Index of the adapter which heard it
+        self.iface = iface
+
+    def __repr__(self):
+        return f"Advert({self.addr}, rssi={self.rssi}, hci{self.iface})"
+
+    def getValueText(self, adtype):
+        value = self.scanData.get(adtype)
+        if value is None:
+            return None
+        if adtype in (COMPLETE_LOCAL_NAME, SHORT_LOCAL_NAME):
+            return value.decode("utf-8", errors="replace")
+        return value.hex()
+
+
+class BrokerClient:
+    """Sends the scan and GATT requests of one collector to the broker.
+
+    Each call blocks until the broker ran the request; queued and radio hold the seconds the
+    last request waited for the adapter and used it.
+    """
+
+    def __init__(self, name, path=DEFAULT_SOCKET, timeout=None):
+        self.name = name
+        self.path = path
+        self.timeout = timeout
+        self.queued = None
+        self.radio = None
+
+    def request(self, op, params, priority=None):
+        request = dict(client=self.name, op=op, params=params)
+        if priority is not None:
+            request["priority"] = priority
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile("rb") as f:
+                line = f.readline()
+
+        if not line:
+            raise BrokerError("the broker closed the connection")
+        response = json.loads(line)
+        if not response.get("ok"):
+            raise BrokerError(response.get("error"))
+        self.queued = response.get("queued")
+        self.radio = response.get("radio")
+        return response["result"]
+
+    def scan(self, targets=(), duration=10, passive=False, adtype=None, priority=None):
+        """Returns the latest advert of the targets (all the devices if none) seen within duration seconds.
+
+        The scan ends as soon as every target sent an advert (with the adtype AD structure, if given).
+        """
+        params = dict(targets=list(targets), duration=duration, passive=passive)
+        if adtype is not None:
+            params["adtype"] = adtype
+        result = self.request("scan", params, priority)
+        return [Advert(**advert) for advert in result["adverts"]]
+
+    def gatt(self, mac, actions, addr_type="public", priority=None):
+        """Runs the actions in one connection to mac, and returns their results.
+
+        Actions are dicts: {"op": "read", "uuid": ...} gives bytes, {"op": "write", "uuid": ...,
+        "value": bytes} gives None, {"op": "notify", "uuid": ..., "count": 1, "timeout": 15}
+        gives the list of the notified values.
+        """
+        actions = [dict(action, value=action["value"].hex()) if "value" in action else action
+                   for action in actions]
+        result = self.request("gatt", dict(mac=mac, addrType=addr_type, actions=actions), priority)
+        return [self._decode(value) for value in result["results"]]
+
+    @staticmethod
+    def _decode(value):
+        if value is None:
+            return None
+        if isinstance(value, list):
+            return [bytes.fromhex(v) for v in value]
+        return bytes.fromhex(value)
+
+    def read(self, mac, uuid, **kwargs):
+        return self.gatt(mac, [dict(op="read", uuid=uuid)], **kwargs)[0]
+
+    def notifications(self, mac, uuid, count=1, timeout=15.0, **kwargs):
+        return self.gatt(mac, [dict(op="notify", uuid=uuid, count=count, timeout=timeout)], **kwargs)[0]
@@ -2,7 +2,9 @@
 
 # inspired by https://github.com/madkaye/ble-ls
 
+import os
 import sys
+import time
 import datetime
 import json
 import logging
@@ -10,36 +12,131 @@ logging.getLogger().setLevel(logging.INFO)
 import argparse
 
 from bluepy import btle
-from bluepy.btle import Scanner, Peripheral, Characteristic, ScanEntry, UUID
+from bluepy.btle import Scanner, Peripheral, Characteristic, ScanEntry, UUID, DefaultDelegate
 import bluepy.btle
 
+import scan_profiles
 import trame
 
+SERVICE_DATA_16B = 0x16
+
+
+def device_name(dev):
+    devname = dev.getValueText(btle.ScanEntry.COMPLETE_LOCAL_NAME)
+    if devname is None:
+        devname = dev.getValueText(btle.ScanEntry.SHORT_LOCAL_NAME)
+    return devname
+
+
+class ScanDelegate(DefaultDelegate):
+    """Hands the adverts to process_data as soon as they are received"""
+
+    def __init__(self, process_data):
+        DefaultDelegate.__init__(self)
+        self.process_data = process_data
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        if not (isNewDev or isNewData):
+            return
+        try:
+            self.process_data(device_name(dev), dev)
+        except Exception as e:
+            print(f"process_data: Exception {e.__class__.__name__}: {e}")
+
 
 class BLELS:
 
     SCAN_TIMEOUT = 10
+    # How often the scan checks if it is done
+    SCAN_SLICE = 0.1
+    # The scanner forgets the devices it has seen at this interval, in watch mode
+    WATCH_CLEAR_INTERVAL = 300
+    WATCH_RESTART_DELAY = 10
     scanner = None
     publicdevices = []
 
-    def scan(self, process_data, duration=SCAN_TIMEOUT):
-        print("scan: starting scan for {}s".format(duration))
-        self.scanner = Scanner()
-        devices = self.scanner.scan(duration)
-        foundDevices = 0
-        for dev in devices:
-            devname = dev.getValueText(btle.ScanEntry.COMPLETE_LOCAL_NAME)
-            if devname is None:
-                devname = dev.getValueText(btle.ScanEntry.SHORT_LOCAL_NAME)
+    def __init__(self, iface=0):
+        # Index of the hci adapter
+        self.iface = iface
+
+    def _windows(self, profile, deadline, is_done, recorder=None):
+        """Scans with the profile until is_done() or the deadline (None: forever).
+
+        A continuous profile is a single window, a duty-cycled one stops the scan between its windows.
+        """
+        last_clear = time.monotonic()
+        while not is_done():
+            window_start = time.monotonic()
+            if deadline is not None and window_start >= deadline:
+                return False
+            window_end = deadline if profile.window is None else window_start + profile.window
+            if deadline is not None:
+                window_end = min(window_end, deadline)
+
+            self.scanner.start(passive=profile.passive)
+            try:
+                while not is_done():
+                    if window_end is None:
+                        timeout = self.WATCH_CLEAR_INTERVAL - (time.monotonic() - last_clear)
+                    else:
+                        timeout = min(window_end - time.monotonic(), self.SCAN_SLICE)
+                        if timeout <= 0:
+                            break
+                    self.scanner.process(max(timeout, 0))
+                    if time.monotonic() - last_clear >= self.WATCH_CLEAR_INTERVAL:
+                        # The scanner keeps an entry per address ever seen (phones rotate theirs)
+                        self.scanner.clear()
+                        last_clear = time.monotonic()
+            finally:
+                helper = getattr(self.scanner, "_helper", None)
+                if recorder is not None and helper is not None:
+                    recorder.add_helper_cpu(scan_profiles.process_cpu(helper.pid))
+                try:
+                    self.scanner.stop()
+                except bluepy.btle.BTLEException:
+                    pass
+
+            if profile.window is not None and not is_done():
+                pause = window_start + profile.interval - time.monotonic()
+                if deadline is not None:
+                    pause = min(pause, deadline - time.monotonic())
+                if pause > 0:
+                    time.sleep(pause)
+        return True
+
+    def scan(self, process_data, profile=None, duration=None, recorder=None):
+        """Hands the adverts to process_data as they are received, until it returns True or duration expires"""
+        profile = profile or scan_profiles.PROFILES[scan_profiles.SCAN_PROFILE]
+        duration = profile.duration if duration is None else duration
+        print("scan: starting scan for at most {}s, profile {}".format(duration, profile))
+        done = []
 
+        def process_advert(devname, dev):
+            if recorder is not None:
+                recorder.seen(dev.addr)
             if process_data(devname, dev):
-                return True
+                done.append(dev.addr)
+
+        self.scanner = Scanner(self.iface).withDelegate(ScanDelegate(process_advert))
+        started = time.monotonic()
+        if not self._windows(profile, started + duration, lambda: bool(done), recorder):
+            return False
+
+        print("scan: done after {:.1f}s".format(time.monotonic() - started))
+        return True
+
+    def watch(self, process_data, profile=None):
+        """Scans continuously (or duty-cycled), and hands every new advert to process_data"""
+        profile = profile or scan_profiles.PROFILES[scan_profiles.WATCH_PROFILE]
+        print("watch: starting scan, profile {}".format(profile))
+        self.scanner = Scanner(self.iface).withDelegate(ScanDelegate(process_data))
+        self._windows(profile, None, lambda: False)
 
     def connectandread(self, addr):
         try:
 
             peri = Peripheral()
-            peri.connect(addr)
+            peri.connect(addr, iface=self.iface)
 
             print("Listing services...")
             services = peri.getServices()
@@ -70,13 +167,68 @@ class BLELS:
             print("connectandread: Error,", e)
 
 
+class BrokerLS:
+    """Same scans as BLELS, run by the ble_broker which owns the adapter"""
+
+    WATCH_RESTART_DELAY = BLELS.WATCH_RESTART_DELAY
+
+    def __init__(self, path, targets):
+        sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "ble_broker"))
+        import broker_client
+        self.broker_client = broker_client
+        self.client = broker_client.BrokerClient("ble_watch", path)
+        self.targets = list(targets)
+
+    def _window(self, process_data, duration, passive):
+        done = False
+        adverts = self.client.scan(self.targets, duration, passive=passive, adtype=SERVICE_DATA_16B)
+        for dev in adverts:
+            try:
+                done = process_data(device_name(dev), dev) or done
+            except Exception as e:
+                print(f"process_data: Exception {e.__class__.__name__}: {e}")
+        print("scan: {} adverts, waited {}s for the radio, scanned {}s".format(
+            len(adverts), self.client.queued, self.client.radio))
+        return done
+
+    # The broker schedules the scan windows itself: only passive and duration apply
+    def scan(self, process_data, profile=None, duration=None, recorder=None):
+        """Hands the adverts to process_data, until it returns True or duration expires"""
+        profile = profile or scan_profiles.PROFILES[scan_profiles.SCAN_PROFILE]
+        duration = profile.duration if duration is None else duration
+        print("scan: asking the broker for at most {}s".format(duration))
+        return self._window(process_data, duration, profile.passive)
+
+    def watch(self, process_data, profile=None):
+        """Asks for scan windows back to back, the broker serves the other clients in between"""
+        profile = profile or scan_profiles.PROFILES[scan_profiles.WATCH_PROFILE]
+        print("watch: starting continuous {} scan through the broker".format("passive" if profile.passive else "active"))
+        while True:
+            try:
+                self._window(process_data, BLELS.SCAN_TIMEOUT, profile.passive)
+            except (self.broker_client.BrokerError, OSError) as e:
+                print(f"Exception {e.__class__.__name__}: {e}")
+                time.sleep(self.WATCH_RESTART_DELAY)
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Xiaomi ATC BLE watcher")
-    parser.add_argument("--target", help="Name and MAC of the device")
+    parser.add_argument("--target", help="Name and MAC of the device (can be repeated)", action="append")
     parser.add_argument("--mine", help="Show my devices", action="store_true")
-    parser.add_argument("--duration", help="Duration of the scan", default=10)
-    parser.add_argument("--tries", help="Number of tries to perform before failing", default=3)
+    parser.add_argument("--duration", help="Duration of the scan [default: the profile's]", type=float)
+    parser.add_argument("--profile", help="Scan profile, see --profiles [default: {} for a scan, {} with --daemon]".format(
+                        scan_profiles.SCAN_PROFILE, scan_profiles.WATCH_PROFILE), choices=scan_profiles.PROFILES)
+    parser.add_argument("--profiles", help="List the scan profiles", action="store_true")
+    parser.add_argument("--benchmark", help="Measure the time to the first advert of the targets with each profile "
+                        "(or the --compare ones), over this number of rounds", type=int, metavar="ROUNDS")
+    parser.add_argument("--compare", help="Profile to benchmark (can be repeated)", action="append",
+                        choices=scan_profiles.PROFILES)
+    parser.add_argument("--tries", help="Number of tries to perform before failing", type=int, default=3)
+    parser.add_argument("--daemon", help="Scan continuously and save the readings as they arrive", action="store_true")
+    parser.add_argument("--broker", help="Scan through the ble_broker listening on this socket", nargs="?",
+                        const="/run/ble_broker.sock", metavar="SOCKET")
+    parser.add_argument("--iface", help="Index of the hci adapter to scan with", type=int, default=0)
 
     try:
         args, unknown = parser.parse_known_args()
@@ -86,23 +238,44 @@ if __name__ == '__main__':
         print("%s" % exc, file=sys.stderr)
         sys.exit(ERROR_ARG)
 
+    if args.profiles:
+        for profile in scan_profiles.PROFILES.values():
+            print(profile)
+        sys.exit(0)
+
     if args.mine or not args.target:
         print(sys.argv[0], "--target bleu_A4:C1:38:45:AF:D5")
         sys.exit(0)
 
-    logging.info(f"Target: {args.target}")
-    location, mac = args.target.split("_")
+    logging.info(f"Targets: {args.target}")
+    targets = {}
+    for target in args.target:
+        location, mac = target.split("_")
+        targets[mac.lower()] = location
 
     print("--- BLE LS Script ---")
-    print(f"mac:      {mac}")
-    print(f"location: {location}")
+    for mac, location in targets.items():
+        print(f"mac:      {mac}")
+        print(f"location: {location}")
     print("--------------------")
 
+    pending = set(targets)
+
+    def scanner():
+        if args.broker:
+            return BrokerLS(args.broker, targets)
+        return BLELS(args.iface)
+
     def process_data(devname, dev):
-        if dev.addr.lower() != mac.lower():
+        location = targets.get(dev.addr.lower())
+        if location is None:
             return
 
-        bin_data = (b"\x12\x16" + dev.scanData[22])
+        service_data = dev.scanData.get(SERVICE_DATA_16B)
+        if service_data is None:
+            return
+
+        bin_data = (b"\x12\x16" + service_data)
 
         data = trame.decode(location, bin_data)
 
@@ -116,11 +289,41 @@ if __name__ == '__main__':
             json.dump(data, f, indent=4)
             print("", file=f)
 
-        return True
+        pending.discard(dev.addr.lower())
+        return not pending
+
+    profile = scan_profiles.PROFILES[args.profile] if args.profile else None
+
+    if args.benchmark:
+        recorder = scan_profiles.ScanRecorder(targets)
+
+        def benchmark_data(devname, dev):
+            process_data(devname, dev)
+            return recorder.round_complete()
+
+        for i in range(args.benchmark):
+            # Interleaved, so that every profile sees the same conditions
+            for name in args.compare or scan_profiles.PROFILES:
+                recorder.start_round(scan_profiles.PROFILES[name])
+                try:
+                    BLELS(args.iface).scan(benchmark_data, scan_profiles.PROFILES[name], args.duration, recorder)
+                except bluepy.btle.BTLEException as e:
+                    print(f"Exception {e.__class__.__name__}: {e}")
+                recorder.end_round()
+            print(recorder.report())
+        logging.info(json.dumps(recorder.stats()))
+        sys.exit(0)
+
+    while args.daemon:
+        try:
+            scanner().watch(process_data, profile)
+        except bluepy.btle.BTLEException as e:
+            print(f"Exception {e.__class__.__name__}: {e}")
+            time.sleep(BLELS.WATCH_RESTART_DELAY)
 
     for i in range(args.tries):
         try:
-            if BLELS().scan(process_data, duration=args.duration):
+            if scanner().scan(process_data, profile, args.duration):
                 break
             print("Not found")
         except bluepy.btle.BTLEDisconnectError as e:
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# Named scan profiles, and a recorder of the time it takes each of them to hear the targets.
+#
+# bluepy does not let us set the HCI scan window/interval (the helper always uses the
+# kernel defaults), so window and interval are applied in software: the scan is started
+# for window seconds every interval seconds, and the radio is off in between.
+
+import collections
+import os
+import statistics
+import time
+
+
+class ScanProfile(collections.namedtuple('ScanProfileBase', ['name', 'passive', 'window', 'interval', 'duration'])):
+    """window/interval in seconds, None for a continuous scan; duration of a one-shot scan"""
+    __slots__ = ()
+
+    @property
+    def duty(self):
+        """Fraction of the time the radio listens"""
+        if self.window is None:
+            return 1.0
+        return min(self.window / self.interval, 1.0)
+
+    def __str__(self):
+        mode = "passive" if self.passive else "active"
+        if self.window is None:
+            return f"{self.name} ({mode}, continuous, {self.duration}s)"
+        return f"{self.name} ({mode}, {self.window}s every {self.interval}s, {self.duration}s)"
+
+
+PROFILES = {profile.name: profile for profile in (
+    # The ATC adverts are in the primary advert, the scan responses only add the name
+    ScanProfile("active", passive=False, window=None, interval=None, duration=10),
+    ScanProfile("passive", passive=True, window=None, interval=None, duration=10),
+    ScanProfile("passive-half", passive=True, window=2.0, interval=4.0, duration=20),
+    ScanProfile("passive-quarter", passive=True, window=2.0, interval=8.0, duration=30),
+    ScanProfile("passive-short", passive=True, window=0.5, interval=2.0, duration=30),
+)}
+
+# Defaults of the one-shot and continuous modes
+SCAN_PROFILE = "active"
+WATCH_PROFILE = "passive"
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def process_cpu(pid):
+    """CPU seconds used by another process (the bluepy helper), 0 if unknown"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # The command name may contain spaces, the fields after it don't
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+class ScanRecorder:
+    """Measures, for every scan round, the time to the first advert of each target, and the CPU used"""
+
+    def __init__(self, targets):
+        self.targets = {mac.lower() for mac in targets}
+        self.rounds = collections.defaultdict(list)  # profile name -> [round]
+        self._round = None
+
+    def start_round(self, profile):
+        self._round = dict(profile=profile, start=time.monotonic(), cpu=time.process_time(),
+                           helper_cpu=0.0, first_seen={})
+
+    def seen(self, addr):
+        addr = addr.lower()
+        if self._round is None or addr not in self.targets or addr in self._round["first_seen"]:
+            return
+        self._round["first_seen"][addr] = time.monotonic() - self._round["start"]
+
+    def add_helper_cpu(self, seconds):
+        if self._round is not None:
+            self._round["helper_cpu"] += seconds
+
+    def round_complete(self):
+        return self._round is not None and self.targets.issubset(self._round["first_seen"])
+
+    def end_round(self):
+        r = self._round
+        self._round = None
+        elapsed = time.monotonic() - r["start"]
+        cpu = time.process_time() - r["cpu"] + r["helper_cpu"]
+        self.rounds[r["profile"].name].append(dict(
+            elapsed=elapsed,
+            cpu_percent=100 * cpu / elapsed if elapsed else 0,
+            first_seen=r["first_seen"],
+            missed=sorted(self.targets - set(r["first_seen"])),
+        ))
+
+    def stats(self):
+        """Per profile: latency to the first advert (over all the targets and rounds), misses, CPU and duty"""
+        stats = {}
+        for name, rounds in self.rounds.items():
+            latencies = sorted(latency for r in rounds for latency in r["first_seen"].values())
+            profile = PROFILES.get(name)
+            entry = dict(
+                rounds=len(rounds),
+                detections=len(latencies),
+                missed=sum(len(r["missed"]) for r in rounds),
+                cpu_percent=round(statistics.mean(r["cpu_percent"] for r in rounds), 2),
+                duty=profile.duty if profile else None,
+            )
+            if latencies:
+                entry.update(
+                    latency_mean=round(statistics.mean(latencies), 3),
+                    latency_p50=round(latencies[len(latencies) // 2], 3),
+                    latency_p95=round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+                    latency_max=round(latencies[-1], 3),
+                )
+            stats[name] = entry
+        return stats
+
+    def report(self):
+        lines = ["{:<16} {:>6} {:>6} {:>6} {:>8} {:>8} {:>8} {:>6} {:>6}".format(
+            "profile", "rounds", "found", "missed", "mean(s)", "p50(s)", "p95(s)", "cpu%", "duty")]
+        for name, s in self.stats().items():
+            lines.append("{:<16} {:>6} {:>6} {:>6} {:>8} {:>8} {:>8} {:>6} {:>6}".format(
+                name, s["rounds"], s["detections"], s["missed"], s.get("latency_mean", "-"),
+                s.get("latency_p50", "-"), s.get("latency_p95", "-"), s["cpu_percent"], s["duty"]))
+        return "\n".join(lines)
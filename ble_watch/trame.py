@@ -37,7 +37,8 @@ DATA_START = START+HEADER_LENGTH+MAC_LENGTH
 DATA_LENGTH = 2+2+2+1+1+1
 SHOW_HEADERS = False
 
-current_counter = 0
+# Last measurement counter decoded, per location
+current_counter = {}
 
 def decode(location, _trame):
     SIZE_UID_UUID = b"\x12\x16\x1a\x18"
@@ -71,10 +72,9 @@ def decode(location, _trame):
     g = globals()
     g.update(kv)
     
-    global current_counter
     import datetime
     print(datetime.datetime.now().time().replace(microsecond=0))
-    if current_counter == counter:
+    if current_counter.get(location) == counter:
         return
 
     if SHOW_HEADERS:
@@ -91,7 +91,7 @@ def decode(location, _trame):
     print(f"batt_lvl\t: {batt_lvl}%")
     print(f"counter\t\t: {counter}")
     print()
-    current_counter = counter
+    current_counter[location] = counter
 
     return kv
 
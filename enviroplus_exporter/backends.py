@@ -0,0 +1,279 @@
+"""Where the readings come from: the Enviro+ sensors, a simulation or a recording.
+
+The drivers are only created, and their libraries imported, when first used, so the exporter
+can run, and be benchmarked, without the Enviro+ or even its libraries.
+"""
+import abc
+import collections
+import csv
+import logging
+import math
+import random
+import struct
+import threading
+import time
+
+from snapshot import Readings
+
+GasReadings = collections.namedtuple('GasReadings', ['oxidising', 'reducing', 'nh3'])
+
+
+class Backend:
+    """The drivers of the sensors: bme280, ltr559, gas and pms5003 (None if it can't be used)"""
+
+    def __init__(self):
+        self._drivers = {}
+        self._lock = threading.Lock()
+
+    def _driver(self, name, create):
+        if name not in self._drivers:
+            with self._lock:
+                if name not in self._drivers:
+                    self._drivers[name] = create()
+        return self._drivers[name]
+
+    @property
+    def bme280(self):
+        return self._driver('bme280', self._create_bme280)
+
+    @property
+    def ltr559(self):
+        return self._driver('ltr559', self._create_ltr559)
+
+    @property
+    def gas(self):
+        return self._driver('gas', self._create_gas)
+
+    @property
+    def pms5003(self):
+        return self._driver('pms5003', self._create_pms5003)
+
+    @property
+    def pms5003_port(self):
+        """The serial port the PMS5003 streams its frames on, None without a PMS5003"""
+        return None if self.pms5003 is None else self._pms5003_port(self.pms5003)
+
+
+class HardwareBackend(Backend):
+    """The sensors of the Enviro+"""
+
+    def _create_bme280(self):
+        from bme280 import BME280
+        try:
+            from smbus2 import SMBus
+        except ImportError:
+            from smbus import SMBus
+        return BME280(i2c_dev=SMBus(1))
+
+    def _create_ltr559(self):
+        try:
+            # Transitional fix for breaking change in LTR559
+            from ltr559 import LTR559
+            return LTR559()
+        except ImportError:
+            import ltr559
+            return ltr559
+
+    def _create_gas(self):
+        from enviroplus import gas
+        return gas
+
+    def _create_pms5003(self):
+        import serial
+        from pms5003 import PMS5003
+        try:
+            return PMS5003()
+        except serial.serialutil.SerialException:
+            logging.warning("Failed to initialise PMS5003.")
+            return None
+
+    def _pms5003_port(self, pms5003):
+        # The pms5003 library opens the port itself and has no public accessor for it: this relies
+        # on its PMS5003 keeping the serial.Serial in _serial. The port can't be opened a second
+        # time instead, both readers would get part of the bytes.
+        return pms5003._serial
+
+
+class SourceBackend(Backend, abc.ABC):
+    """Drivers answering with the readings of reading(name), a field of Readings"""
+
+    @abc.abstractmethod
+    def reading(self, name):
+        """The current value of the name field of Readings"""
+
+    def _create_bme280(self):
+        return _BME280(self.reading)
+
+    def _create_ltr559(self):
+        return _LTR559(self.reading)
+
+    def _create_gas(self):
+        return _Gas(self.reading)
+
+    def _create_pms5003(self):
+        return _PMS5003(self.reading)
+
+    def _pms5003_port(self, pms5003):
+        return pms5003.port
+
+
+class SimulatorBackend(SourceBackend):
+    """Plausible readings: daily cycles of temperature, humidity and light, slowly drifting
+    pressure, noisy gas resistances and particulates, and now and then something close by
+    """
+
+    DAY = 24 * 3600
+
+    def __init__(self, seed=None):
+        super().__init__()
+        self._random = random.Random(seed)
+        self._pm_second = None
+        self._pm_level = 4.0
+
+    def reading(self, name):
+        r = self._random
+        day = math.sin(2 * math.pi * (time.time() % self.DAY) / self.DAY)
+        if name == 'temperature':
+            return 20 + 3 * day + r.gauss(0, 0.05)
+        if name == 'humidity':
+            return min(max(50 - 10 * day + r.gauss(0, 0.5), 0), 100)
+        if name == 'pressure':
+            return 997 + 5 * math.sin(2 * math.pi * time.time() / (3 * self.DAY)) + r.gauss(0, 0.1)
+        if name == 'lux':
+            return max(500 * day + r.gauss(0, 5), 0)
+        if name == 'proximity':
+            return r.randint(500, 1500) if r.random() < 0.01 else r.randint(0, 5)
+        if name == 'oxidising':
+            return r.gauss(20000, 500)
+        if name == 'reducing':
+            return r.gauss(300000, 5000)
+        if name == 'nh3':
+            return r.gauss(700000, 10000)
+        if name == 'pm1':
+            return round(self._pm())
+        if name == 'pm25':
+            return round(self._pm() * 1.6)
+        if name == 'pm10':
+            return round(self._pm() * 2)
+        raise KeyError(name)
+
+    def _pm(self):
+        # A random walk around 4 ug/m3, one step per second so that the sizes stay consistent
+        second = int(time.time())
+        if second != self._pm_second:
+            self._pm_second = second
+            self._pm_level = max(self._pm_level + 0.05 * (4 - self._pm_level) + self._random.gauss(0, 0.3), 0.5)
+        return self._pm_level
+
+
+class ReplayBackend(SourceBackend):
+    """Readings of a CSV file with a column per field of Readings, such as the ones --record
+    writes, one row every interval seconds, looping at the end
+    """
+
+    def __init__(self, path, interval=1.0):
+        super().__init__()
+        with open(path, newline='') as f:
+            self._rows = [{name: float(row[name]) for name in Readings._fields} for row in csv.DictReader(f)]
+        if not self._rows:
+            raise ValueError('No readings in {}'.format(path))
+        self._interval = interval
+        self._start = time.monotonic()
+
+    def reading(self, name):
+        row = int((time.monotonic() - self._start) / self._interval) % len(self._rows)
+        return self._rows[row][name]
+
+
+class Recorder:
+    """Appends the readings to a CSV file that ReplayBackend can replay"""
+
+    def __init__(self, path):
+        self._file = open(path, 'a', newline='')
+        self._writer = csv.writer(self._file)
+        if self._file.tell() == 0:
+            self._writer.writerow(('time',) + Readings._fields)
+
+    def record(self, readings):
+        self._writer.writerow((round(time.time(), 3),) + tuple(readings))
+        self._file.flush()
+
+
+class _BME280:
+
+    def __init__(self, reading):
+        self._reading = reading
+
+    def get_temperature(self):
+        return self._reading('temperature')
+
+    def get_pressure(self):
+        return self._reading('pressure')
+
+    def get_humidity(self):
+        return self._reading('humidity')
+
+
+class _LTR559:
+
+    def __init__(self, reading):
+        self._reading = reading
+
+    def get_lux(self):
+        return self._reading('lux')
+
+    def get_proximity(self):
+        return self._reading('proximity')
+
+
+class _Gas:
+
+    def __init__(self, reading):
+        self._reading = reading
+
+    def read_all(self):
+        return GasReadings(self._reading('oxidising'), self._reading('reducing'), self._reading('nh3'))
+
+
+class _PMS5003:
+    """Has the serial port of a PMS5003, streaming a frame every second"""
+
+    def __init__(self, reading):
+        self.port = _FramePort(reading)
+
+    def reset(self):
+        pass
+
+
+class _FramePort:
+
+    FRAME = struct.Struct('>2sH13H')
+    INTERVAL = 1.0
+
+    def __init__(self, reading):
+        self._reading = reading
+        self._buffer = bytearray()
+        self._next_frame = time.monotonic()
+
+    def _frame(self):
+        pm = [int(self._reading(name)) for name in ('pm1', 'pm25', 'pm10')]
+        # Standard and atmospheric concentrations, particle counts, version and error code
+        frame = self.FRAME.pack(b'\x42\x4d', 28, *(pm + pm + [0] * 7))
+        return frame + struct.pack('>H', sum(frame))
+
+    @property
+    def in_waiting(self):
+        return len(self._buffer)
+
+    def read(self, size=1):
+        while len(self._buffer) < size:
+            wait = self._next_frame - time.monotonic()
+            if wait > 0:
+                if self._buffer:
+                    break
+                time.sleep(wait)
+            self._buffer += self._frame()
+            self._next_frame += self.INTERVAL
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
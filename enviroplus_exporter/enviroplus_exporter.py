@@ -1,38 +1,25 @@
 #!/usr/bin/env python3
 import os
 import random
-import requests
 import time
 import logging
 import argparse
 import subprocess
-import serial
-from threading import Thread
+import sys
+from threading import Thread, Lock
 
-from prometheus_client import start_http_server, Gauge, Histogram
+from prometheus_client import start_http_server, Gauge, Histogram, REGISTRY
 
-from bme280 import BME280
-from enviroplus import gas
-from pms5003 import PMS5003, ReadTimeoutError as pmsReadTimeoutError, SerialTimeoutError as pmsSerialTimeoutError
-
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
+from scheduler import Scheduler
+from window import Windows
+from snapshot import Snapshot, SnapshotCollector
+from particulates import PMS5003Reader
+from influx import InfluxWriter
+from backends import HardwareBackend, SimulatorBackend, ReplayBackend, Recorder
 
 import datetime
 import time
 
-try:
-    from smbus2 import SMBus
-except ImportError:
-    from smbus import SMBus
-
-try:
-    # Transitional fix for breaking change in LTR559
-    from ltr559 import LTR559
-    ltr559 = LTR559()
-except ImportError:
-    import ltr559
-
 logging.basicConfig(
     format='%(asctime)s.%(msecs)03d %(levelname)-8s %(message)s',
     level=logging.INFO,
@@ -48,24 +35,12 @@ Press Ctrl+C to exit!
 
 DEBUG = os.getenv('DEBUG', 'false') == 'true'
 
-bus = SMBus(1)
-bme280 = BME280(i2c_dev=bus)
-try:
-    pms5003 = PMS5003()
-except serial.serialutil.SerialException:
-    logging.warning("Failed to initialise PMS5003.")
-
-TEMPERATURE = Gauge('temperature','Temperature measured (*C)')
-PRESSURE = Gauge('pressure','Pressure measured (hPa)')
-HUMIDITY = Gauge('humidity','Relative humidity measured (%)')
-OXIDISING = Gauge('oxidising','Mostly nitrogen dioxide but could include NO and Hydrogen (Ohms)')
-REDUCING = Gauge('reducing', 'Mostly carbon monoxide but could include H2S, Ammonia, Ethanol, Hydrogen, Methane, Propane, Iso-butane (Ohms)')
-NH3 = Gauge('NH3', 'mostly Ammonia but could also include Hydrogen, Ethanol, Propane, Iso-butane (Ohms)') 
-LUX = Gauge('lux', 'current ambient light level (lux)')
-PROXIMITY = Gauge('proximity', 'proximity, with larger numbers being closer proximity and vice versa')
-PM1 = Gauge('PM1', 'Particulate Matter of diameter less than 1 micron. Measured in micrograms per cubic metre (ug/m3)')
-PM25 = Gauge('PM25', 'Particulate Matter of diameter less than 2.5 microns. Measured in micrograms per cubic metre (ug/m3)')
-PM10 = Gauge('PM10', 'Particulate Matter of diameter less than 10 microns. Measured in micrograms per cubic metre (ug/m3)')
+# The sensor drivers, created on first use
+backend = HardwareBackend()
+
+# The latest readings, exposed through a collector and read by the InfluxDB and Luftdaten threads
+SNAPSHOT = Snapshot()
+REGISTRY.register(SnapshotCollector(SNAPSHOT))
 
 OXIDISING_HIST = Histogram('oxidising_measurements', 'Histogram of oxidising measurements', buckets=(0, 10000, 15000, 20000, 25000, 30000, 35000, 40000, 45000, 50000, 55000, 60000, 65000, 70000, 75000, 80000, 85000, 90000, 100000))
 REDUCING_HIST = Histogram('reducing_measurements', 'Histogram of reducing measurements', buckets=(0, 100000, 200000, 300000, 400000, 500000, 600000, 700000, 800000, 900000, 1000000, 1100000, 1200000, 1300000, 1400000, 1500000))
@@ -75,6 +50,17 @@ PM1_HIST = Histogram('pm1_measurements', 'Histogram of Particulate Matter of dia
 PM25_HIST = Histogram('pm25_measurements', 'Histogram of Particulate Matter of diameter less than 2.5 micron measurements', buckets=(0, 5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75, 80, 85, 90, 95, 100))
 PM10_HIST = Histogram('pm10_measurements', 'Histogram of Particulate Matter of diameter less than 10 micron measurements', buckets=(0, 5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75, 80, 85, 90, 95, 100))
 
+# Min, max, mean, last value and number of samples of each reading over the last WINDOW_SECONDS
+WINDOW_SECONDS = float(os.getenv('WINDOW_SECONDS', '60'))
+WINDOW_SIZE = int(os.getenv('WINDOW_SIZE', '600'))
+WINDOWS = Windows(WINDOW_SECONDS, WINDOW_SIZE)
+REGISTRY.register(WINDOWS)
+
+THERMOMETER_TEMPERATURE = Gauge('thermometer_temperature', 'Temperature measured by an ATC thermometer (*C)', ['mac', 'name'])
+THERMOMETER_HUMIDITY = Gauge('thermometer_humidity', 'Relative humidity measured by an ATC thermometer (%)', ['mac', 'name'])
+THERMOMETER_BATTERY = Gauge('thermometer_battery', 'Battery level of an ATC thermometer (%)', ['mac', 'name'])
+THERMOMETER_RSSI = Gauge('thermometer_rssi', 'Signal strength of an ATC thermometer (dBm)', ['mac', 'name'])
+
 
 # Setup InfluxDB
 # You can generate an InfluxDB Token from the Tokens Tab in the InfluxDB Cloud UI
@@ -84,16 +70,46 @@ INFLUXDB_ORG_ID = os.getenv('INFLUXDB_ORG_ID', '')
 INFLUXDB_BUCKET = os.getenv('INFLUXDB_BUCKET', '')
 INFLUXDB_SENSOR_LOCATION = os.getenv('INFLUXDB_SENSOR_LOCATION', 'Adelaide')
 INFLUXDB_TIME_BETWEEN_POSTS = int(os.getenv('INFLUXDB_TIME_BETWEEN_POSTS', '5'))
-influxdb_client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG_ID)
-influxdb_api = influxdb_client.write_api(write_options=SYNCHRONOUS)
+# The points are written in batches, and spooled to disk while InfluxDB can't be reached
+INFLUXDB_BATCH_SIZE = int(os.getenv('INFLUXDB_BATCH_SIZE', '100'))
+INFLUXDB_FLUSH_INTERVAL = int(os.getenv('INFLUXDB_FLUSH_INTERVAL', '60'))
+INFLUXDB_SPOOL_DIR = os.getenv('INFLUXDB_SPOOL_DIR', os.path.expanduser('~/.cache/enviroplus_exporter/influxdb'))
+INFLUXDB_SPOOL_MAX_MB = int(os.getenv('INFLUXDB_SPOOL_MAX_MB', '50'))
 
 # Setup Luftdaten
 LUFTDATEN_TIME_BETWEEN_POSTS = int(os.getenv('LUFTDATEN_TIME_BETWEEN_POSTS', '30'))
+# Shortest time between two uploads of the same readings, retries included
+LUFTDATEN_MIN_INTERVAL = int(os.getenv('LUFTDATEN_MIN_INTERVAL', '30'))
+
+# Setup the ATC thermometers scan
+THERMOMETERS_IFACE = int(os.getenv('THERMOMETERS_IFACE', '0'))
+# Socket of the ble_broker owning the adapter; the thermometers scan goes through it when set
+BLE_BROKER = os.getenv('BLE_BROKER')
+# A ble_broker listening there owns hci0: the exporter won't scan it behind its back
+BROKER_SOCKET = '/run/ble_broker.sock'
+
+# Sensor read cadences and timeouts, in seconds
+LIGHT_INTERVAL = float(os.getenv('LIGHT_INTERVAL', '1'))
+WEATHER_INTERVAL = float(os.getenv('WEATHER_INTERVAL', '1'))
+PARTICULATES_INTERVAL = float(os.getenv('PARTICULATES_INTERVAL', '10'))
+GAS_INTERVAL = float(os.getenv('GAS_INTERVAL', '10'))
+SENSOR_TIMEOUT = float(os.getenv('SENSOR_TIMEOUT', '10'))
+
+# The PMS5003 frames are read as they come, in the background
+pms_reader = None
 
 # Sometimes the sensors can't be read. Resetting the i2c 
+i2c_reset_lock = Lock()
+
 def reset_i2c():
-    subprocess.run(['i2cdetect', '-y', '1'])
-    time.sleep(2)
+    # The sensors are read concurrently, several of them may fail at once
+    if not i2c_reset_lock.acquire(blocking=False):
+        return
+    try:
+        subprocess.run(['i2cdetect', '-y', '1'])
+        time.sleep(2)
+    finally:
+        i2c_reset_lock.release()
 
 
 # Get the temperature of the CPU for compensation
@@ -107,7 +123,7 @@ def get_temperature(factor):
     """Get temperature from the weather sensor"""
     # Tuning factor for compensation. Decrease this number to adjust the
     # temperature down, and increase to adjust up
-    raw_temp = bme280.get_temperature()
+    raw_temp = backend.bme280.get_temperature()
 
     if factor:
         cpu_temps = [get_cpu_temperature()] * 5
@@ -119,14 +135,16 @@ def get_temperature(factor):
     else:
         temperature = raw_temp
 
-    TEMPERATURE.set(temperature)   # Set to a given value
+    SNAPSHOT.update(temperature=temperature)
+    WINDOWS.add('temperature', temperature)
 
 def get_pressure():
     """Get pressure from the weather sensor"""
     try:
         PRESSURE_OFFSET = 16
-        pressure = bme280.get_pressure() + PRESSURE_OFFSET
-        PRESSURE.set(pressure)
+        pressure = backend.bme280.get_pressure() + PRESSURE_OFFSET
+        SNAPSHOT.update(pressure=pressure)
+        WINDOWS.add('pressure', pressure)
     except IOError:
         logging.error("Could not get pressure readings. Resetting i2c.")
         reset_i2c()
@@ -134,24 +152,32 @@ def get_pressure():
 def get_humidity():
     """Get humidity from the weather sensor"""
     try:
-        humidity = bme280.get_humidity()
-        HUMIDITY.set(humidity)
+        humidity = backend.bme280.get_humidity()
+        SNAPSHOT.update(humidity=humidity)
+        WINDOWS.add('humidity', humidity)
     except IOError:
         logging.error("Could not get humidity readings. Resetting i2c.")
         reset_i2c()
 
+def get_weather(factor):
+    """Get all the readings of the BME280 weather sensor"""
+    get_temperature(factor)
+    get_pressure()
+    get_humidity()
+
 def get_gas():
     """Get all gas readings"""
     try:
-        readings = gas.read_all()
+        readings = backend.gas.read_all()
+        SNAPSHOT.update(oxidising=readings.oxidising, reducing=readings.reducing, nh3=readings.nh3)
 
-        OXIDISING.set(readings.oxidising)
+        WINDOWS.add('oxidising', readings.oxidising)
         OXIDISING_HIST.observe(readings.oxidising)
 
-        REDUCING.set(readings.reducing)
+        WINDOWS.add('reducing', readings.reducing)
         REDUCING_HIST.observe(readings.reducing)
 
-        NH3.set(readings.nh3)
+        WINDOWS.add('nh3', readings.nh3)
         NH3_HIST.observe(readings.nh3)
     except IOError:
         logging.error("Could not get gas readings. Resetting i2c.")
@@ -160,117 +186,116 @@ def get_gas():
 def get_light():
     """Get all light readings"""
     try:
-       lux = ltr559.get_lux()
-       prox = ltr559.get_proximity()
+       lux = backend.ltr559.get_lux()
+       prox = backend.ltr559.get_proximity()
 
-       LUX.set(lux)
-       PROXIMITY.set(prox)
+       SNAPSHOT.update(lux=lux, proximity=prox)
+       WINDOWS.add('lux', lux)
+       WINDOWS.add('proximity', prox)
     except IOError:
         logging.error("Could not get lux and proximity readings. Resetting i2c.")
         reset_i2c()
 
-def get_particulates():
-    """Get the particulate matter readings"""
-    try:
-        pms_data = pms5003.read()
-    except pmsReadTimeoutError:
-        logging.warning("Timed out reading PMS5003.")
-    except (IOError, pmsSerialTimeoutError):
-        logging.warning("Could not get particulate matter readings.")
-    else:
-        PM1.set(pms_data.pm_ug_per_m3(1.0))
-        PM25.set(pms_data.pm_ug_per_m3(2.5))
-        PM10.set(pms_data.pm_ug_per_m3(10))
+def record_particulates(pms_data):
+    """Called by the PMS5003 reader for every frame"""
+    WINDOWS.add('pm1', pms_data.pm_ug_per_m3(1.0))
+    WINDOWS.add('pm25', pms_data.pm_ug_per_m3(2.5))
+    WINDOWS.add('pm10', pms_data.pm_ug_per_m3(10))
 
-        PM1_HIST.observe(pms_data.pm_ug_per_m3(1.0))
-        PM25_HIST.observe(pms_data.pm_ug_per_m3(2.5) - pms_data.pm_ug_per_m3(1.0))
-        PM10_HIST.observe(pms_data.pm_ug_per_m3(10) - pms_data.pm_ug_per_m3(2.5))
+def get_particulates():
+    """Get the particulate matter readings, averaged since the last ones"""
+    if pms_reader is None:
+        return
+    pm = pms_reader.average(PARTICULATES_INTERVAL)
+    if pm is None:
+        logging.warning("No frame from the PMS5003 in the last {}s.".format(PARTICULATES_INTERVAL))
+        return
+    SNAPSHOT.update(pm1=pm[1.0], pm25=pm[2.5], pm10=pm[10])
+
+    PM1_HIST.observe(pm[1.0])
+    PM25_HIST.observe(pm[2.5] - pm[1.0])
+    PM10_HIST.observe(pm[10] - pm[2.5])
+
+def update_thermometer(thermometer):
+    """Called by the thermometers scan for every new ATC advert"""
+    labels = (thermometer.mac, thermometer.local_name)
+    THERMOMETER_TEMPERATURE.labels(*labels).set(thermometer.temp)
+    THERMOMETER_HUMIDITY.labels(*labels).set(thermometer.hum)
+    THERMOMETER_BATTERY.labels(*labels).set(thermometer.battery)
+    THERMOMETER_RSSI.labels(*labels).set(thermometer.rssi)
+    if DEBUG:
+        logging.info('Thermometer {} ({}): {} *C, {} %'.format(thermometer.mac, thermometer.local_name, thermometer.temp, thermometer.hum))
+
+def start_thermometers():
+    """Scans continuously for the ATC thermometers in the background"""
+    # The lywsd02 package lives next to the LYWSD03MMC exporter
+    sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lywsd03mmc"))
+    from lywsd03mmc import AtcMiThermometerClient
+    broker = None
+    if not BLE_BROKER and THERMOMETERS_IFACE == 0 and os.path.exists(BROKER_SOCKET):
+        logging.error("The ble_broker at {} owns hci0, not scanning for the thermometers: set BLE_BROKER to scan through it, or THERMOMETERS_IFACE to a dedicated adapter".format(BROKER_SOCKET))
+        return None
+    if BLE_BROKER:
+        sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "ble_broker"))
+        import broker_client
+        broker = broker_client.BrokerClient('enviroplus_exporter', BLE_BROKER)
+    client = AtcMiThermometerClient(iface=THERMOMETERS_IFACE, broker=broker)
+    client.start(update_thermometer)
+    return client
 
 def collect_all_data():
-    """Collects all the data currently set"""
-    sensor_data = {}
-    sensor_data['temperature'] = TEMPERATURE.collect()[0].samples[0].value
-    sensor_data['humidity'] = HUMIDITY.collect()[0].samples[0].value
-    sensor_data['pressure'] = PRESSURE.collect()[0].samples[0].value
-    sensor_data['oxidising'] = OXIDISING.collect()[0].samples[0].value
-    sensor_data['reducing'] = REDUCING.collect()[0].samples[0].value
-    sensor_data['nh3'] = NH3.collect()[0].samples[0].value
-    sensor_data['lux'] = LUX.collect()[0].samples[0].value
-    sensor_data['proximity'] = PROXIMITY.collect()[0].samples[0].value
-    sensor_data['pm1'] = PM1.collect()[0].samples[0].value
-    sensor_data['pm25'] = PM25.collect()[0].samples[0].value
-    sensor_data['pm10'] = PM10.collect()[0].samples[0].value
-    return sensor_data
+    """The current readings (a Readings snapshot), consistent with each other"""
+    return SNAPSHOT.current
 
 def post_to_influxdb():
     """Post all sensor data to InfluxDB"""
-    name = 'enviroplus'
-    tag = ['location', 'adelaide']
+    from influxdb_client import InfluxDBClient, Point, WritePrecision
+    from influxdb_client.client.write_api import SYNCHRONOUS
+
+    influxdb_client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG_ID, enable_gzip=True)
+    influxdb_api = influxdb_client.write_api(write_options=SYNCHRONOUS)
+
+    def write_to_influxdb(lines):
+        """Write a batch of line protocol points to InfluxDB"""
+        influxdb_api.write(bucket=INFLUXDB_BUCKET, record=lines, write_precision=WritePrecision.S)
+        if DEBUG:
+            logging.info('InfluxDB response: OK')
+
+    writer = InfluxWriter(write_to_influxdb, INFLUXDB_SPOOL_DIR, batch_size=INFLUXDB_BATCH_SIZE,
+                          flush_interval=INFLUXDB_FLUSH_INTERVAL, spool_max_bytes=INFLUXDB_SPOOL_MAX_MB * 1024 * 1024)
+    writer.start()
     while True:
         time.sleep(INFLUXDB_TIME_BETWEEN_POSTS)
-        data_points = []
         epoch_time_now = round(time.time())
         sensor_data = collect_all_data()
-        for field_name in sensor_data:
-            data_points.append(Point('enviroplus').tag('location', INFLUXDB_SENSOR_LOCATION).field(field_name, sensor_data[field_name]))
-        try:
-            influxdb_api.write(bucket=INFLUXDB_BUCKET, record=data_points)
-            if DEBUG:
-                logging.info('InfluxDB response: OK')
-        except Exception as exception:
-            logging.warning('Exception sending to InfluxDB: {}'.format(exception))
+        # The points are written later, they carry the time they were taken
+        point = Point('enviroplus').tag('location', INFLUXDB_SENSOR_LOCATION).time(epoch_time_now, WritePrecision.S)
+        for field_name, value in zip(sensor_data._fields, sensor_data):
+            point.field(field_name, value)
+        writer.add(point.to_line_protocol())
 
 def post_to_luftdaten():
     """Post relevant sensor data to luftdaten.info"""
     """Code from: https://github.com/sepulworld/balena-environ-plus"""
+    from luftdaten import LuftdatenUploader
+
     LUFTDATEN_SENSOR_UID = 'raspi-' + get_serial_number()
+    uploader = LuftdatenUploader(LUFTDATEN_SENSOR_UID, min_interval=LUFTDATEN_MIN_INTERVAL)
+    next_post = time.monotonic() + LUFTDATEN_TIME_BETWEEN_POSTS
     while True:
-        time.sleep(LUFTDATEN_TIME_BETWEEN_POSTS)
-        sensor_data = collect_all_data()
-        values = {}
-        values["P2"] = sensor_data['pm25']
-        values["P1"] = sensor_data['pm10']
-        values["temperature"] = "{:.2f}".format(sensor_data['temperature'])
-        values["pressure"] = "{:.2f}".format(sensor_data['pressure'] * 100)
-        values["humidity"] = "{:.2f}".format(sensor_data['humidity'])
-        pm_values = dict(i for i in values.items() if i[0].startswith('P'))
-        temperature_values = dict(i for i in values.items() if not i[0].startswith('P'))
-        try:
-            response_pin_1 = requests.post('https://api.luftdaten.info/v1/push-sensor-data/',
-                json={
-                    "software_version": "enviro-plus 0.0.1",
-                    "sensordatavalues": [{"value_type": key, "value": val} for
-                                        key, val in pm_values.items()]
-                },
-                headers={
-                    "X-PIN":    "1",
-                    "X-Sensor": LUFTDATEN_SENSOR_UID,
-                    "Content-Type": "application/json",
-                    "cache-control": "no-cache"
-                }
-            )
-
-            response_pin_11 = requests.post('https://api.luftdaten.info/v1/push-sensor-data/',
-                    json={
-                        "software_version": "enviro-plus 0.0.1",
-                        "sensordatavalues": [{"value_type": key, "value": val} for
-                                            key, val in temperature_values.items()]
-                    },
-                    headers={
-                        "X-PIN":    "11",
-                        "X-Sensor": LUFTDATEN_SENSOR_UID,
-                        "Content-Type": "application/json",
-                        "cache-control": "no-cache"
-                    }
-            )
-
-            if response_pin_1.ok and response_pin_11.ok:
-                if DEBUG:
-                    logging.info('Luftdaten response: OK')
-            else:
-                logging.warning('Luftdaten response: Failed')
-        except Exception as exception:
-            logging.warning('Exception sending to Luftdaten: {}'.format(exception))
+        time.sleep(1)
+        if time.monotonic() >= next_post:
+            next_post += LUFTDATEN_TIME_BETWEEN_POSTS
+            sensor_data = collect_all_data()
+            values = {}
+            values["P2"] = sensor_data.pm25
+            values["P1"] = sensor_data.pm10
+            values["temperature"] = "{:.2f}".format(sensor_data.temperature)
+            values["pressure"] = "{:.2f}".format(sensor_data.pressure * 100)
+            values["humidity"] = "{:.2f}".format(sensor_data.humidity)
+            uploader.submit(values)
+        # Also retries the failed uploads, once they are due
+        uploader.upload_due()
 
 def get_serial_number():
     """Get Raspberry Pi serial number to use as LUFTDATEN_SENSOR_UID"""
@@ -296,6 +321,11 @@ if __name__ == '__main__':
     parser.add_argument("-d", "--debug", metavar='DEBUG', type=str_to_bool, help="Turns on more verbose logging, showing sensor output and post responses [default: false]")
     parser.add_argument("-i", "--influxdb", metavar='INFLUXDB', type=str_to_bool, default='false', help="Post sensor data to InfluxDB [default: false]")
     parser.add_argument("-l", "--luftdaten", metavar='LUFTDATEN', type=str_to_bool, default='false', help="Post sensor data to Luftdaten [default: false]")
+    parser.add_argument("--backend", choices=['hardware', 'simulator', 'replay'], default='hardware', help="Where the readings come from: the Enviro+ sensors, a simulation, or the recording given with --replay [default: hardware]")
+    parser.add_argument("--replay", metavar='FILE', help="CSV file of readings to replay, one row per second, as written by --record")
+    parser.add_argument("--record", metavar='FILE', help="Append the readings to a CSV file every second")
+    parser.add_argument("--benchmark", metavar='SECONDS', type=float, help="Read the sensors for SECONDS, then report the reads per second and the CPU used, and exit")
+    parser.add_argument("-t", "--thermometers", metavar='THERMOMETERS', type=str_to_bool, default='false', help="Scan continuously for Xiaomi thermometers running the ATC firmware and expose their readings [default: false]")
     args = parser.parse_args()
         
     # Generate some requests.
@@ -303,22 +333,36 @@ if __name__ == '__main__':
     if args.debug:
         DEBUG = True
 
+    if args.backend == 'simulator':
+        logging.info("Simulating the sensors")
+        backend = SimulatorBackend()
+    elif args.backend == 'replay':
+        if not args.replay:
+            parser.error("--backend=replay needs --replay")
+        logging.info("Replaying the readings of {}".format(args.replay))
+        backend = ReplayBackend(args.replay)
+
     if args.factor:
         logging.info("Using compensating algorithm (factor={}) to account for heat leakage from Raspberry Pi board".format(args.factor))
 
     if args.influxdb:
         # Post to InfluxDB in another thread
-        logging.info("Sensor data will be posted to InfluxDB every {} seconds".format(INFLUXDB_TIME_BETWEEN_POSTS))
-        influx_thread = Thread(target=post_to_influxdb)
+        logging.info("Sensor data will be posted to InfluxDB every {} seconds, in batches of {} points or every {} seconds".format(INFLUXDB_TIME_BETWEEN_POSTS, INFLUXDB_BATCH_SIZE, INFLUXDB_FLUSH_INTERVAL))
+        influx_thread = Thread(target=post_to_influxdb, daemon=True)
         influx_thread.start()
 
     if args.luftdaten:
         # Post to Luftdaten in another thread
         LUFTDATEN_SENSOR_UID = 'raspi-' + get_serial_number()
         logging.info("Sensor data will be posted to Luftdaten every {} seconds for the UID {}".format(LUFTDATEN_TIME_BETWEEN_POSTS, LUFTDATEN_SENSOR_UID))
-        luftdaten_thread = Thread(target=post_to_luftdaten)
+        luftdaten_thread = Thread(target=post_to_luftdaten, daemon=True)
         luftdaten_thread.start()
 
+    if args.thermometers:
+        if start_thermometers() is not None:
+            logging.info("Scanning for ATC thermometers {}".format(
+                "through the broker at {}".format(BLE_BROKER) if BLE_BROKER else "on hci{}".format(THERMOMETERS_IFACE)))
+
     if args.port > 0:
         # Start up the server to expose the metrics.
         start_http_server(addr=args.bind, port=args.port)
@@ -327,14 +371,30 @@ if __name__ == '__main__':
         logging.info("No port specified, running in debug mode.")
         DEBUG = True
 
-    while True:
-        get_temperature(args.factor)
-        get_pressure()
-        get_humidity()
-        get_light()
-        if not args.enviro:
-            get_gas()
-            get_particulates()
-        if DEBUG:
-            logging.info('Sensor data: {}'.format(collect_all_data()))
-        time.sleep(30)
+    # Each sensor is read in its own worker, so a slow or broken one doesn't delay the others
+    scheduler = Scheduler()
+    scheduler.add('light', get_light, LIGHT_INTERVAL, SENSOR_TIMEOUT)
+    scheduler.add('weather', lambda: get_weather(args.factor), WEATHER_INTERVAL, SENSOR_TIMEOUT)
+    if not args.enviro and backend.pms5003 is not None:
+        pms_reader = PMS5003Reader(backend.pms5003, backend.pms5003_port, on_frame=record_particulates)
+        pms_reader.start()
+    if not args.enviro:
+        scheduler.add('gas', get_gas, GAS_INTERVAL, SENSOR_TIMEOUT)
+        scheduler.add('particulates', get_particulates, PARTICULATES_INTERVAL, SENSOR_TIMEOUT)
+    if DEBUG:
+        scheduler.add('debug', lambda: logging.info('Sensor data: {}'.format(collect_all_data())), 30, SENSOR_TIMEOUT)
+    if args.record:
+        recorder = Recorder(args.record)
+        scheduler.add('record', lambda: recorder.record(collect_all_data()), 1, SENSOR_TIMEOUT)
+
+    if args.benchmark:
+        cpu = time.process_time()
+        scheduler.run(args.benchmark)
+        cpu = time.process_time() - cpu
+        for task in scheduler.tasks:
+            logging.info("{}: {} reads, {:.1f} per second".format(task.name, task.runs, task.runs / args.benchmark))
+        if pms_reader is not None:
+            logging.info("particulates: {} frames".format(pms_reader.frame_count))
+        logging.info("CPU: {:.2f}s in {}s ({:.1f}%)".format(cpu, args.benchmark, 100 * cpu / args.benchmark))
+    else:
+        scheduler.run()
@@ -0,0 +1,153 @@
+"""Writes the points to InfluxDB in batches, spooling them to disk while it's unreachable"""
+import gzip
+import logging
+import os
+import threading
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+
+WRITE_SECONDS = Histogram('influxdb_write_seconds', 'Duration of the InfluxDB writes (s)', buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+WRITE_ERRORS = Counter('influxdb_write_errors', 'Failed InfluxDB writes')
+WRITTEN = Counter('influxdb_points_written', 'Points written to InfluxDB')
+DROPPED = Counter('influxdb_points_dropped', 'Points dropped because the spool was full, or its file unreadable')
+PENDING = Gauge('influxdb_pending_points', 'Points waiting for the next batch')
+SPOOL_POINTS = Gauge('influxdb_spool_points', 'Points spooled to disk, waiting for InfluxDB')
+SPOOL_BYTES = Gauge('influxdb_spool_bytes', 'Size of the spooled batches (compressed)')
+
+
+class InfluxWriter:
+    """Batches line protocol points and writes them from a background thread.
+
+    A batch that can't be written is spooled to disk, as a gzipped file. The spooled batches
+    are written back, oldest first, before any new batch, so the points reach InfluxDB in
+    order. The oldest batches are dropped when the spool grows beyond spool_max_bytes.
+
+    write is synchronous, so that a failed batch is known and spooled: the thread waits for
+    each write, one at a time. The points added meanwhile aren't blocked, they wait in the
+    next batch, which is then bigger than batch_size. The client's own batching write API
+    would retry from memory and report the failures to a callback, out of the spool's reach.
+    """
+
+    def __init__(self, write, spool_dir, batch_size=100, flush_interval=60, spool_max_bytes=50 * 1024 * 1024):
+        # write(lines) sends the line protocol lines, and raises if it can't
+        self._write = write
+        self._spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_max_bytes = spool_max_bytes
+        self._pending = []
+        self._condition = threading.Condition()
+        self._thread = None
+        os.makedirs(spool_dir, exist_ok=True)
+        self._update_spool_metrics()
+
+    def add(self, line):
+        with self._condition:
+            self._pending.append(line)
+            PENDING.set(len(self._pending))
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='influxdb', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            deadline = time.monotonic() + self.flush_interval
+            with self._condition:
+                while len(self._pending) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch, self._pending = self._pending, []
+                PENDING.set(0)
+            self.flush(batch)
+
+    def flush(self, batch):
+        # The spooled batches go first, to keep the points in order
+        if not self._replay():
+            if batch:
+                self._spool(batch)
+            return
+        if batch and not self._send(batch):
+            self._spool(batch)
+
+    def _send(self, lines):
+        started = time.monotonic()
+        try:
+            self._write('\n'.join(lines))
+        except Exception as exception:
+            WRITE_ERRORS.inc()
+            logging.warning('Exception sending to InfluxDB: {}'.format(exception))
+            return False
+        WRITE_SECONDS.observe(time.monotonic() - started)
+        WRITTEN.inc(len(lines))
+        return True
+
+    # Spool files: <time in ns>-<number of points>.lp.gz, so that they sort in order
+
+    def _spooled(self):
+        return sorted(name for name in os.listdir(self._spool_dir) if name.endswith('.lp.gz'))
+
+    @staticmethod
+    def _points(name):
+        return int(name.split('.')[0].split('-')[1])
+
+    def _spool(self, batch):
+        name = '{:020d}-{}.lp.gz'.format(time.time_ns(), len(batch))
+        path = os.path.join(self._spool_dir, name)
+        try:
+            with gzip.open(path + '.tmp', 'wt') as f:
+                f.write('\n'.join(batch))
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            logging.warning('Cannot spool {} InfluxDB points: {}'.format(len(batch), e))
+            DROPPED.inc(len(batch))
+            return
+        logging.info('InfluxDB unreachable, spooled {} points'.format(len(batch)))
+        self._trim()
+        self._update_spool_metrics()
+
+    def _trim(self):
+        names = self._spooled()
+        sizes = {name: os.path.getsize(os.path.join(self._spool_dir, name)) for name in names}
+        total = sum(sizes.values())
+        for name in names:
+            if total <= self.spool_max_bytes:
+                break
+            os.remove(os.path.join(self._spool_dir, name))
+            total -= sizes[name]
+            DROPPED.inc(self._points(name))
+            logging.warning('InfluxDB spool full, dropped {} points'.format(self._points(name)))
+
+    def _replay(self):
+        """Writes the spooled batches back, False if one of them can't be"""
+        replayed = dropped = 0
+        for name in self._spooled():
+            path = os.path.join(self._spool_dir, name)
+            try:
+                with gzip.open(path, 'rt') as f:
+                    lines = f.read().split('\n')
+            except (OSError, EOFError) as e:
+                logging.warning('Dropping the unreadable InfluxDB spool file {}: {}'.format(name, e))
+                DROPPED.inc(self._points(name))
+                os.remove(path)
+                dropped += 1
+                self._update_spool_metrics()
+                continue
+            if not self._send(lines):
+                return False
+            os.remove(path)
+            replayed += 1
+            self._update_spool_metrics()
+        if replayed or dropped:
+            logging.info('InfluxDB back, replayed {} spooled batches, dropped {} unreadable ones'.format(replayed, dropped))
+        return True
+
+    def _update_spool_metrics(self):
+        names = self._spooled()
+        SPOOL_POINTS.set(sum(self._points(name) for name in names))
+        SPOOL_BYTES.set(sum(os.path.getsize(os.path.join(self._spool_dir, name)) for name in names))
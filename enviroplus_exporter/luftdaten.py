@@ -0,0 +1,110 @@
+"""Uploads the readings to sensor.community (formerly luftdaten.info)"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from prometheus_client import Counter, Gauge, Histogram
+
+URL = 'https://api.luftdaten.info/v1/push-sensor-data/'
+SOFTWARE_VERSION = 'enviro-plus 0.0.1'
+
+# The readings of each X-PIN: 1 for the particulate sensor, 11 for the BME280
+PINS = {
+    '1': ('P2', 'P1'),
+    '11': ('temperature', 'pressure', 'humidity'),
+}
+
+UPLOAD_SECONDS = Histogram('luftdaten_upload_seconds', 'Duration of the Luftdaten uploads (s)', ['pin'], buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20))
+UPLOADS = Counter('luftdaten_uploads', 'Successful Luftdaten uploads', ['pin'])
+FAILURES = Counter('luftdaten_upload_failures', 'Failed Luftdaten uploads', ['pin'])
+SUPERSEDED = Counter('luftdaten_uploads_superseded', 'Readings never uploaded because newer ones replaced them', ['pin'])
+PENDING = Gauge('luftdaten_pending', 'Whether readings are waiting to be uploaded', ['pin'])
+
+
+class Pin:
+    """The readings waiting to be uploaded for a pin, and when they may be"""
+
+    def __init__(self, name):
+        self.name = name
+        self.values = None
+        self.next_upload = 0
+        self.failures = 0  # consecutive
+
+
+class LuftdatenUploader:
+    """Uploads the readings of both pins concurrently, over a keep-alive session.
+
+    Luftdaten readings have no timestamp, so only the latest readings of a pin are kept for a
+    retry. A pin is uploaded at most every min_interval seconds, and failed uploads are
+    retried later and later, up to max_backoff seconds, or when the server says to.
+    """
+
+    def __init__(self, sensor_uid, min_interval=30, max_backoff=600, timeout=(5, 10)):
+        self.min_interval = min_interval
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self._session = requests.Session()
+        self._session.headers.update({
+            "X-Sensor": sensor_uid,
+            "Content-Type": "application/json",
+            "cache-control": "no-cache",
+        })
+        self._pins = {name: Pin(name) for name in PINS}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=len(PINS), thread_name_prefix='luftdaten')
+
+    def submit(self, values):
+        """Queues new readings ({value_type: value}) for upload"""
+        with self._lock:
+            for pin in self._pins.values():
+                if pin.values is not None:
+                    SUPERSEDED.labels(pin.name).inc()
+                pin.values = {key: values[key] for key in PINS[pin.name]}
+                PENDING.labels(pin.name).set(1)
+
+    def upload_due(self):
+        """Uploads the pins which are due, concurrently, and waits for them"""
+        now = time.monotonic()
+        with self._lock:
+            due = [(pin, pin.values) for pin in self._pins.values()
+                   if pin.values is not None and pin.next_upload <= now]
+        for future in [self._executor.submit(self._upload, pin, values) for pin, values in due]:
+            future.result()
+
+    def _upload(self, pin, values):
+        started = time.monotonic()
+        retry_after = None
+        try:
+            response = self._session.post(URL, timeout=self.timeout, headers={"X-PIN": pin.name}, json={
+                "software_version": SOFTWARE_VERSION,
+                "sensordatavalues": [{"value_type": key, "value": val} for key, val in values.items()],
+            })
+            ok = response.ok
+            if not ok:
+                logging.warning('Luftdaten response for pin {}: {} {}'.format(pin.name, response.status_code, response.reason))
+                if response.status_code == 429:
+                    retry_after = response.headers.get('Retry-After')
+        except requests.RequestException as exception:
+            ok = False
+            logging.warning('Exception sending to Luftdaten: {}'.format(exception))
+        UPLOAD_SECONDS.labels(pin.name).observe(time.monotonic() - started)
+
+        with self._lock:
+            if ok:
+                UPLOADS.labels(pin.name).inc()
+                pin.failures = 0
+                delay = self.min_interval
+                # Unless newer readings came in the meantime
+                if pin.values is values:
+                    pin.values = None
+                    PENDING.labels(pin.name).set(0)
+            else:
+                FAILURES.labels(pin.name).inc()
+                pin.failures += 1
+                delay = min(self.min_interval * 2 ** (pin.failures - 1), self.max_backoff)
+                if retry_after is not None and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+            pin.next_upload = time.monotonic() + delay
+        return ok
@@ -2,21 +2,32 @@ from lywsd02 import Lywsd02Client
 import struct
 import collections
 from datetime import datetime, timedelta
+import logging
+import threading
+import time
 
 import re
-from bluepy.btle import Scanner, DefaultDelegate
+from bluepy.btle import Scanner, DefaultDelegate, ScanEntry
 import bluepy
 
 UUID_HISTORY = 'EBE0CCBC-7A0A-4B0C-8A1A-6FF2997DA3A6'  # Last idx 152          READ NOTIFY
 UUID_FIRMWARE = '00002a26-0000-1000-8000-00805f9b34fb'   # handle: 0x0012 firmware revision
 UUID_HARDWARE = '00002a27-0000-1000-8000-00805f9b34fb'   # handle: 0x0014 hardware revision
 
+# ATC firmware advert, in the 16b service data: UUID 0x181A (little endian), then big endian
+# MAC, temperature (x 0.1 degree), humidity (%), battery (%), battery (mV) and frame counter
+ATC_SERVICE_UUID = b'\x1a\x18'
+ATC_FORMAT = struct.Struct('>2s6shBBH')
+ATC_LENGTH = ATC_FORMAT.size + 1  # with the frame counter
+
+_LOGGER = logging.getLogger(__name__)
+
+MAC_PATTERN = re.compile(r"(A4:C1:38)|(A4:C1:38):[0-9A-F]{2}:[0-9A-F]{2}:[0-9A-F]{2}")
+
 
 def valid_miflora_mac(mac):
-    refilter = r"(A4:C1:38)|(A4:C1:38):[0-9A-F]{2}:[0-9A-F]{2}:[0-9A-F]{2}"
-    pat = re.compile(refilter)
     """Check for valid mac adresses."""
-    if not pat.match(mac.upper()):
+    if not MAC_PATTERN.match(mac.upper()):
         return False
     return True
 
@@ -160,27 +171,47 @@ class ScanDelegate(DefaultDelegate):
             print("Received new data from", dev.addr)
 
 
+class ContinuousScanDelegate(DefaultDelegate):
+    """Hands the adverts of a continuous scan to the client as they come"""
+
+    def __init__(self, client):
+        DefaultDelegate.__init__(self)
+        self._client = client
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        if isNewDev or isNewData:
+            self._client._discovered(dev)
+
+
 class AtcMiThermometerDevice():
 
+    __slots__ = ('_mac', '_temp', '_hum', '_battery', '_volts', '_skip', '_rssi', '_local_name')
+
     def _process_sensor_data(self, data):
-        datas = []
-        for i in range(0, 15):
-            datas.append(data[i*2:2+i*2])
-        self._mac = ':'.join(datas[2:8]).upper()
-        self._temp = int('0x' + ''.join(datas[8:10]), base=16)/10
-        self._hum = int('0x' + ''.join(datas[10:11]), base=16)
-        self._battery = int('0x' + ''.join(datas[11:12]), base=16)
-        self._volts = int('0x' + ''.join(datas[12:14]), base=16)/1000
+        (_, mac, temp, self._hum, self._battery, volts) = ATC_FORMAT.unpack_from(data)
+        self._mac = ':'.join('{:02X}'.format(b) for b in mac)
+        self._temp = temp / 10
+        self._volts = volts / 1000
         self._skip = False
-        if datas[14] == '':
+        if len(data) < ATC_LENGTH:
             print('skip', self._mac)
             self._skip = True
         self._rssi = None
         self._local_name = None
 
     def __init__(self, data):
+        # The raw service data, or its hex string as given by bluepy's getScanData()
+        if isinstance(data, str):
+            data = bytes.fromhex(data)
         self._process_sensor_data(data)
 
+    @classmethod
+    def from_service_data(cls, data):
+        """The device of an ATC advert, None if the service data isn't one"""
+        if data is None or len(data) < ATC_FORMAT.size or data[:2] != ATC_SERVICE_UUID:
+            return None
+        return cls(data)
+
     def __str__(self):
         result = '{}: \t{} - {}'.format('mac', self._mac, self._local_name)
         result += '\n{}: \t{} °C'.format('temp', self._temp)
@@ -236,16 +267,42 @@ class AtcMiThermometerDevice():
 
 class AtcMiThermometerClient():
 
-    def __init__(self, scan_for=15.0, retry=3, debug=False):
+    # Seconds of scanning between two clears of the scanner's device list
+    CLEAR_EVERY = 60
+    # Seconds to wait before restarting a failed continuous scan
+    RESTART_DELAY = 10
+    # Seconds of the scan windows asked to the broker, back to back
+    BROKER_WINDOW = 10
+
+    # broker: a broker_client.BrokerClient, to scan through the ble_broker owning the adapter
+    # instead of with iface
+    def __init__(self, scan_for=15.0, retry=3, debug=False, iface=0, max_thermometers=64, broker=None):
         self._scan_for = scan_for
         self._retry = retry
         self._devices = []
         self._thermometers = []
         self._debug = debug
+        self._iface = iface
+        self._broker = broker
+        # Continuous mode: the latest reading per MAC, oldest updated first
+        self._latest = collections.OrderedDict()
+        self._max_thermometers = max_thermometers
+        self._callback = None
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
 
     def _get_datas(self):
         devices = []
-        scanner = Scanner().withDelegate(ScanDelegate())
+        if self._broker is not None:
+            try:
+                devices = self._broker.scan(duration=self._scan_for, passive=True, adtype=ScanEntry.SERVICE_DATA_16B)
+            except Exception as err:
+                print(err)
+                print('Proceed...')
+            self._devices = devices
+            return
+        scanner = Scanner(self._iface).withDelegate(ScanDelegate())
         try:
             devices = scanner.scan(self._scan_for)
         except (bluepy.btle.BTLEManagementError,
@@ -256,43 +313,116 @@ class AtcMiThermometerClient():
         self._devices = devices
 
     def get_datas(self):
+        """Scans for scan_for seconds, retrying until a thermometer is found"""
+        self._thermometers = []
         trycount = 0
-        while (len(self._devices) == 0) and (trycount < self._retry):
+        while (len(self._thermometers) == 0) and (trycount < self._retry):
             trycount += 1
             self._get_datas()
-        self._process_datas()
+            self._process_datas()
+
+    def _thermometer(self, dev):
+        """The thermometer of a scanned device, None if it isn't advertising an ATC reading"""
+        if valid_miflora_mac(dev.addr) is False:
+            return None
+        if self._debug:
+            # scanData rather than getScanData(), which the adverts relayed by the broker don't have
+            for adtype, val in dev.scanData.items():
+                print("  %s = %s" % (adtype, val.hex()))
+        thermometer = AtcMiThermometerDevice.from_service_data(dev.scanData.get(ScanEntry.SERVICE_DATA_16B))
+        if thermometer is None:
+            return None
+        if dev.addr.upper() != thermometer.mac:
+            return None
+        local_name = dev.scanData.get(ScanEntry.COMPLETE_LOCAL_NAME)
+        local_name = local_name.decode('utf-8', 'replace') if local_name else "not available"
+        thermometer.rssi = dev.rssi
+        thermometer.local_name = local_name
+        if self._debug:
+            print(thermometer)
+        return thermometer
 
     def _process_datas(self):
         for dev in self._devices:
-            if valid_miflora_mac(dev.addr) is False:
-                continue
-            strf = "Device {} ({}), RSSI={} dB"
-            # print(strf.format(dev.addr, dev.addrType, dev.rssi))
-            local_name = ''
-            value = ''
-            for (adtype, desc, val) in dev.getScanData():
-                if self._debug:
-                    print("  %s = %s" % (desc, val))
-                if desc == "16b Service Data":
-                    value = val
-                elif desc == "Complete Local Name":
-                    local_name = val
-
-            # print('{} : {}'.format(local_name, value))
-            if local_name == '':
-                local_name = "not available"
-            if value == '':
-                continue
-            # print("  %s = %s" % (desc, value))
+            thermometer = self._thermometer(dev)
+            if thermometer is not None:
+                self._thermometers.append(thermometer)
+
+    def start(self, callback=None):
+        """Scans continuously in a background thread.
 
-            thermometer = AtcMiThermometerDevice(value)
-            if dev.addr.upper() != thermometer.mac.upper():
+        The latest reading of each thermometer is kept in latest, and callback(thermometer) is
+        called from the scanning thread for every new reading.
+        """
+        if self._running:
+            return
+        self._callback = callback
+        self._running = True
+        self._thread = threading.Thread(target=self._scan_continuously, name='atc-scan', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _scan_continuously(self):
+        if self._broker is not None:
+            self._scan_with_broker()
+            return
+        while self._running:
+            scanner = Scanner(self._iface).withDelegate(ContinuousScanDelegate(self))
+            try:
+                scanner.start(passive=True)
+                cleared = time.monotonic()
+                while self._running:
+                    scanner.process(1.0)
+                    # The scanner otherwise remembers every device it ever saw
+                    if time.monotonic() - cleared > self.CLEAR_EVERY:
+                        scanner.clear()
+                        cleared = time.monotonic()
+            except bluepy.btle.BTLEException as err:
+                _LOGGER.warning('Thermometer scan failed, restarting in %ss: %s', self.RESTART_DELAY, err)
+                time.sleep(self.RESTART_DELAY)
+            finally:
+                try:
+                    scanner.stop()
+                except bluepy.btle.BTLEException:
+                    pass
+
+    def _scan_with_broker(self):
+        # The broker merges these windows with the scans of the other collectors
+        while self._running:
+            try:
+                adverts = self._broker.scan(duration=self.BROKER_WINDOW, passive=True, adtype=ScanEntry.SERVICE_DATA_16B)
+            except Exception as err:
+                _LOGGER.warning('Thermometer scan through the broker failed, retrying in %ss: %s', self.RESTART_DELAY, err)
+                time.sleep(self.RESTART_DELAY)
                 continue
-            thermometer.rssi = dev.rssi
-            thermometer.local_name = local_name
-            if self._debug:
-                print(thermometer)
-            self._thermometers.append(thermometer)
+            for advert in adverts:
+                self._discovered(advert)
+
+    def _discovered(self, dev):
+        thermometer = self._thermometer(dev)
+        if thermometer is None or thermometer.skip:
+            return
+        with self._lock:
+            self._latest.pop(thermometer.mac, None)
+            self._latest[thermometer.mac] = thermometer
+            while len(self._latest) > self._max_thermometers:
+                self._latest.popitem(last=False)
+        if self._callback is not None:
+            try:
+                self._callback(thermometer)
+            except Exception:
+                _LOGGER.exception('Thermometer callback failed')
+
+    @property
+    def latest(self):
+        """{mac: thermometer} of the latest readings of the continuous scan"""
+        with self._lock:
+            return dict(self._latest)
 
     @property
     def scan_for(self):
@@ -0,0 +1,160 @@
+"""Reads the frames the PMS5003 streams about every second, in the background"""
+import collections
+import logging
+import struct
+import threading
+import time
+
+from prometheus_client import Counter, Gauge
+
+SOF = b'\x42\x4d'
+HEADER = struct.Struct('>2sH')
+FRAME_LENGTH = 28  # 13 readings and the checksum
+FRAME = struct.Struct('>14H')
+
+FRAMES = Counter('pms5003_frames', 'Valid frames read from the PMS5003')
+CHECKSUM_ERRORS = Counter('pms5003_checksum_errors', 'Frames from the PMS5003 with a wrong checksum')
+FRAME_ERRORS = Counter('pms5003_frame_errors', 'Frame headers from the PMS5003 with an unexpected length')
+SKIPPED_BYTES = Counter('pms5003_skipped_bytes', 'Bytes from the PMS5003 skipped to find the start of a frame')
+BACKLOG = Gauge('pms5003_backlog_bytes', 'Bytes waiting in the serial input buffer at the last read')
+BACKLOG_MAX = Gauge('pms5003_backlog_max_bytes', 'Most bytes ever waiting in the serial input buffer')
+STALLS = Counter('pms5003_stalls', 'Times the PMS5003 stopped sending frames and was reset')
+
+
+class Frame:
+    """The readings of a frame, read like the pms5003 library's PMS5003Data"""
+
+    __slots__ = ('data', 'checksum')
+
+    def __init__(self, raw_data):
+        self.data = FRAME.unpack(raw_data)
+        self.checksum = self.data[13]
+
+    def pm_ug_per_m3(self, size, atmospheric_environment=False):
+        offset = 3 if atmospheric_environment else 0
+        return self.data[offset + {1.0: 0, 2.5: 1, 10: 2}[size]]
+
+
+class PMS5003Reader:
+    """Parses and checks the PMS5003 frames as they come, into a ring of the last size frames.
+
+    pms5003.read() only reads the frame at the head of the serial buffer, which is stale (or
+    partial) when it isn't called every second, so the frames are read from its serial port,
+    port, instead. pms5003 is only used to reset the sensor.
+    """
+
+    # Seconds without a frame before resetting the sensor
+    FRAME_TIMEOUT = 10
+
+    def __init__(self, pms5003, port, size=300, on_frame=None):
+        self._pms5003 = pms5003
+        self._port = port
+        self._frames = collections.deque(maxlen=size)
+        self._on_frame = on_frame
+        self._buffer = bytearray()
+        self._backlog_max = 0
+        self._last_frame = time.monotonic()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='pms5003', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while self._running:
+            try:
+                self._read()
+            except OSError as e:
+                logging.warning('Could not read the PMS5003: {}'.format(e))
+                time.sleep(1)
+            if time.monotonic() - self._last_frame > self.FRAME_TIMEOUT:
+                logging.warning('No frame from the PMS5003 for {}s, resetting it'.format(self.FRAME_TIMEOUT))
+                STALLS.inc()
+                self._buffer.clear()
+                self._last_frame = time.monotonic()
+                try:
+                    self._pms5003.reset()
+                except OSError as e:
+                    logging.warning('Could not reset the PMS5003: {}'.format(e))
+
+    def _read(self):
+        port = self._port
+        waiting = port.in_waiting
+        BACKLOG.set(waiting)
+        if waiting > self._backlog_max:
+            self._backlog_max = waiting
+            BACKLOG_MAX.set(waiting)
+        # Blocks for up to the port timeout when nothing is waiting
+        chunk = port.read(max(waiting, 1))
+        if chunk:
+            self._buffer += chunk
+            self._parse()
+
+    def _parse(self):
+        buffer = self._buffer
+        while True:
+            start = buffer.find(SOF)
+            if start < 0:
+                # Keep a trailing first byte of the start of frame
+                keep = 1 if buffer.endswith(SOF[:1]) else 0
+                SKIPPED_BYTES.inc(len(buffer) - keep)
+                del buffer[:len(buffer) - keep]
+                return
+            if start:
+                SKIPPED_BYTES.inc(start)
+                del buffer[:start]
+            if len(buffer) < HEADER.size:
+                return
+            length = HEADER.unpack_from(buffer)[1]
+            if length != FRAME_LENGTH:
+                FRAME_ERRORS.inc()
+                del buffer[:len(SOF)]
+                continue
+            end = HEADER.size + length
+            if len(buffer) < end:
+                return
+            data = Frame(buffer[HEADER.size:end])
+            # The checksum covers the whole frame but its own two bytes
+            if sum(buffer[:end - 2]) != data.checksum:
+                CHECKSUM_ERRORS.inc()
+                del buffer[:len(SOF)]
+                continue
+            del buffer[:end]
+            self._add(data)
+
+    def _add(self, data):
+        now = time.monotonic()
+        self._last_frame = now
+        self._frames.append((now, data))
+        FRAMES.inc()
+        if self._on_frame is not None:
+            self._on_frame(data)
+
+    @property
+    def frame_count(self):
+        """Number of frames in the ring, at most its size"""
+        return len(self._frames)
+
+    def latest(self):
+        """(age in seconds, Frame) of the last frame, None before the first one"""
+        try:
+            received, data = self._frames[-1]
+        except IndexError:
+            return None
+        return time.monotonic() - received, data
+
+    def average(self, seconds):
+        """{1.0, 2.5, 10: mean ug/m3} of the frames of the last seconds, None without frames"""
+        since = time.monotonic() - seconds
+        frames = [data for received, data in list(self._frames) if received >= since]
+        if not frames:
+            return None
+        return {size: sum(data.pm_ug_per_m3(size) for data in frames) / len(frames) for size in (1.0, 2.5, 10)}
@@ -0,0 +1,84 @@
+"""Runs the sensor reads on their own cadence, each sensor in its own worker"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from prometheus_client import Counter, Gauge
+
+READ_SECONDS = Gauge('sensor_read_seconds', 'Duration of the last read of a sensor (s)', ['sensor'])
+OVERRUNS = Counter('sensor_overruns', 'Reads of a sensor skipped because the previous one was still running', ['sensor'])
+STALLED = Gauge('sensor_stalled', 'Whether a read of the sensor has been running for longer than its timeout', ['sensor'])
+
+
+class Task:
+    """A sensor read, run every interval seconds"""
+
+    def __init__(self, name, function, interval, timeout):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.timeout = timeout
+        self.next_run = 0
+        self.started = None
+        self.future = None
+        self.stalled = False
+        self.runs = 0
+        # A single worker per sensor: a hung read only ever blocks its own sensor
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    def _run(self):
+        started = time.monotonic()
+        self.runs += 1
+        try:
+            self.function()
+        except Exception:
+            logging.exception('Reading {} failed'.format(self.name))
+        finally:
+            READ_SECONDS.labels(self.name).set(time.monotonic() - started)
+
+
+class Scheduler:
+    """Starts the due reads at a fixed period, whatever the reads take"""
+
+    def __init__(self, tick=0.1):
+        self.tick = tick
+        self.tasks = []
+
+    def add(self, name, function, interval, timeout):
+        self.tasks.append(Task(name, function, interval, timeout))
+        # Check at least as often as the fastest sensor is read
+        self.tick = min(self.tick, interval)
+        STALLED.labels(name).set(0)
+
+    def run(self, duration=None):
+        """Runs forever, or for duration seconds"""
+        for task in self.tasks:
+            logging.info('Reading {} every {}s (timeout {}s)'.format(task.name, task.interval, task.timeout))
+        end = None if duration is None else time.monotonic() + duration
+        while end is None or time.monotonic() < end:
+            now = time.monotonic()
+            for task in self.tasks:
+                self._check(task, now)
+            time.sleep(self.tick)
+
+    def _check(self, task, now):
+        running = task.future is not None and not task.future.done()
+        if running and not task.stalled and now - task.started > task.timeout:
+            task.stalled = True
+            STALLED.labels(task.name).set(1)
+            logging.warning('Reading {} has been running for more than {}s'.format(task.name, task.timeout))
+        if now < task.next_run:
+            return
+        # Keep the cadence: the next read is due one interval after this one was, not after it ends
+        task.next_run += task.interval
+        if task.next_run <= now:
+            task.next_run = now + task.interval
+        if running:
+            OVERRUNS.labels(task.name).inc()
+            return
+        if task.stalled:
+            task.stalled = False
+            STALLED.labels(task.name).set(0)
+            logging.info('Reading {} recovered'.format(task.name))
+        task.started = now
+        task.future = task.executor.submit(task._run)
@@ -0,0 +1,53 @@
+"""The latest readings of the sensors, as one immutable snapshot"""
+import collections
+import threading
+
+from prometheus_client.core import GaugeMetricFamily
+
+# Reading -> (metric name, help)
+METRICS = collections.OrderedDict([
+    ('temperature', ('temperature', 'Temperature measured (*C)')),
+    ('humidity', ('humidity', 'Relative humidity measured (%)')),
+    ('pressure', ('pressure', 'Pressure measured (hPa)')),
+    ('oxidising', ('oxidising', 'Mostly nitrogen dioxide but could include NO and Hydrogen (Ohms)')),
+    ('reducing', ('reducing', 'Mostly carbon monoxide but could include H2S, Ammonia, Ethanol, Hydrogen, Methane, Propane, Iso-butane (Ohms)')),
+    ('nh3', ('NH3', 'mostly Ammonia but could also include Hydrogen, Ethanol, Propane, Iso-butane (Ohms)')),
+    ('lux', ('lux', 'current ambient light level (lux)')),
+    ('proximity', ('proximity', 'proximity, with larger numbers being closer proximity and vice versa')),
+    ('pm1', ('PM1', 'Particulate Matter of diameter less than 1 micron. Measured in micrograms per cubic metre (ug/m3)')),
+    ('pm25', ('PM25', 'Particulate Matter of diameter less than 2.5 microns. Measured in micrograms per cubic metre (ug/m3)')),
+    ('pm10', ('PM10', 'Particulate Matter of diameter less than 10 microns. Measured in micrograms per cubic metre (ug/m3)')),
+])
+
+
+class Readings(collections.namedtuple('Readings', METRICS.keys())):
+    __slots__ = ()
+
+
+class Snapshot:
+    """Holds the current Readings, replaced as a whole on every update.
+
+    Readers just take current: it is never modified, so its readings are consistent with each
+    other, without locking or copying. Only the writers, the sensor workers, are serialised.
+    """
+
+    def __init__(self):
+        self.current = Readings(*[0.0] * len(Readings._fields))
+        self._lock = threading.Lock()
+
+    def update(self, **readings):
+        with self._lock:
+            self.current = self.current._replace(**readings)
+
+
+class SnapshotCollector:
+    """Prometheus collector of the current readings, one gauge per reading"""
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    def collect(self):
+        readings = self._snapshot.current
+        for field, value in zip(readings._fields, readings):
+            name, documentation = METRICS[field]
+            yield GaugeMetricFamily(name, documentation, value=value)
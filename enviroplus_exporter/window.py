@@ -0,0 +1,85 @@
+"""Recent samples of the sensors, summarised over a time window on each scrape"""
+import threading
+import time
+
+import numpy
+from prometheus_client.core import GaugeMetricFamily
+
+STATS = ('min', 'max', 'mean', 'last', 'samples')
+
+
+class RingBuffer:
+    """The last size samples of a reading, with their (monotonic) time"""
+
+    def __init__(self, size):
+        self._values = numpy.full(size, numpy.nan)
+        self._times = numpy.full(size, -numpy.inf)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def append(self, value, now=None):
+        with self._lock:
+            self._values[self._next] = value
+            self._times[self._next] = time.monotonic() if now is None else now
+            self._next = (self._next + 1) % len(self._values)
+
+    def window(self, seconds, now=None):
+        """The samples of the last seconds, oldest first"""
+        since = (time.monotonic() if now is None else now) - seconds
+        with self._lock:
+            # Unroll the ring so that the last sample is the last of the array
+            order = numpy.roll(numpy.arange(len(self._values)), -self._next)
+            times = self._times[order]
+            values = self._values[order]
+        return values[times >= since]
+
+
+class Windows:
+    """Prometheus collector of the min, max, mean, last value and number of samples of each reading
+    over the last seconds.
+
+    Gauges only show the value at the time of the scrape, short spikes between two scrapes are lost.
+    """
+
+    def __init__(self, seconds, size):
+        self.seconds = seconds
+        self.size = size
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, value):
+        buffer = self._buffers.get(name)
+        if buffer is None:
+            with self._lock:
+                buffer = self._buffers.setdefault(name, RingBuffer(self.size))
+        buffer.append(value)
+
+    def summary(self, name):
+        """{stat: value} of a reading over the window, None without samples"""
+        buffer = self._buffers.get(name)
+        values = buffer.window(self.seconds) if buffer is not None else ()
+        if not len(values):
+            return None
+        return dict(min=values.min().item(), max=values.max().item(), mean=values.mean().item(),
+                    last=values[-1].item(), samples=len(values))
+
+    def _families(self):
+        return {stat: GaugeMetricFamily('window_' + stat, '{} of a reading over the last {}s'.format(
+            'Number of samples' if stat == 'samples' else stat.capitalize() + ' value', self.seconds), labels=['sensor'])
+            for stat in STATS}
+
+    def describe(self):
+        return self._families().values()
+
+    def collect(self):
+        families = self._families()
+        with self._lock:
+            names = sorted(self._buffers)
+        for name in names:
+            summary = self.summary(name)
+            if summary is None:
+                families['samples'].add_metric([name], 0)
+                continue
+            for stat, value in summary.items():
+                families[stat].add_metric([name], value)
+        return families.values()
@@ -5,13 +5,53 @@ This runs in isolation to prevent file descriptor leaks.
 """
 import asyncio
 import json
+import os
 import sys
 import time
-from bleak import BleakScanner
+
+# Socket of the ble_broker owning the adapter; the scan goes through it when set
+BLE_BROKER = os.getenv('BLE_BROKER')
+
+
+def decode_manufacturer_data(company_id, payload):
+    # Our discovered logic: Key is temp, Payload[5] is battery
+    temp_c = company_id / 100.0
+    battery = payload[5] if len(payload) >= 6 else None
+
+    return {
+        "found": True,
+        "temperature": temp_c,
+        "battery": battery,
+        "timestamp": time.time(),
+        "error": None
+    }
+
+
+def scan_with_broker(target_mac, timeout=5.0):
+    """Same as scan_for_device, the broker schedules the scan with the other collectors."""
+    sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "ble_broker"))
+    import broker_client
+
+    try:
+        adverts = broker_client.BrokerClient("inkbird", BLE_BROKER).scan(
+            [target_mac], duration=timeout, adtype=broker_client.MANUFACTURER)
+    except Exception as e:
+        return {"found": False, "error": str(e), "timestamp": time.time()}
+
+    if not adverts:
+        return {"found": False, "error": None, "timestamp": time.time()}
+
+    # The AD structure starts with the little endian company id, as bleak splits it
+    m_data = adverts[0].scanData[broker_client.MANUFACTURER]
+    if len(m_data) < 2:
+        return {"found": False, "error": "No valid manufacturer data", "timestamp": time.time()}
+    return decode_manufacturer_data(int.from_bytes(m_data[:2], "little"), m_data[2:])
 
 
 async def scan_for_device(target_mac, timeout=5.0):
     """Scan for a specific device and return its data."""
+    from bleak import BleakScanner
+
     try:
         devices_dict = await BleakScanner.discover(return_adv=True, timeout=timeout)
 
@@ -25,17 +65,7 @@ async def scan_for_device(target_mac, timeout=5.0):
             return {"found": False, "error": "No manufacturer data", "timestamp": time.time()}
 
         for company_id, payload in m_data.items():
-            # Our discovered logic: Key is temp, Payload[5] is battery
-            temp_c = company_id / 100.0
-            battery = payload[5] if len(payload) >= 6 else None
-
-            return {
-                "found": True,
-                "temperature": temp_c,
-                "battery": battery,
-                "timestamp": time.time(),
-                "error": None
-            }
+            return decode_manufacturer_data(company_id, payload)
 
         return {"found": False, "error": "No valid manufacturer data", "timestamp": time.time()}
 
@@ -50,6 +80,11 @@ def main():
 
     target_mac = sys.argv[1].upper()
 
+    if BLE_BROKER:
+        # No collisions to retry on, the broker runs one scan at a time
+        print(json.dumps(scan_with_broker(target_mac)))
+        return
+
     # Retry logic for "Operation already in progress" errors
     max_retries = 3
     for attempt in range(max_retries):
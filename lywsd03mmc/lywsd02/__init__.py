@@ -1,5 +1,9 @@
 from .client import Lywsd02Client
+from .handles import HandleCache
+from .history import HistoryBuffer
 
 __all__ = (
     'Lywsd02Client',
+    'HandleCache',
+    'HistoryBuffer',
 )
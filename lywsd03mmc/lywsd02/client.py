@@ -7,6 +7,9 @@ from datetime import datetime
 
 from bluepy import btle
 
+from .handles import HandleCache
+from .history import HistoryBuffer
+
 _LOGGER = logging.getLogger(__name__)
 
 UUID_UNITS = 'EBE0CCBE-7A0A-4B0C-8A1A-6FF2997DA3A6'  # 0x00 - F, 0x01 - C    READ WRITE
@@ -14,6 +17,10 @@ UUID_HISTORY = 'EBE0CCBC-7A0A-4B0C-8A1A-6FF2997DA3A6'  # Last idx 152          R
 UUID_TIME = 'EBE0CCB7-7A0A-4B0C-8A1A-6FF2997DA3A6'  # 5 or 4 bytes          READ WRITE
 UUID_DATA = 'EBE0CCC1-7A0A-4B0C-8A1A-6FF2997DA3A6'  # 3 bytes               READ NOTIFY
 UUID_BATTERY = 'EBE0CCC4-7A0A-4B0C-8A1A-6FF2997DA3A6'
+UUID_FIRMWARE = '00002A26-0000-1000-8000-00805F9B34FB'  # Firmware revision string READ
+UUID_HARDWARE = '00002A27-0000-1000-8000-00805F9B34FB'  # Hardware revision string READ
+
+UUID_CCCD = 0x2902
 
 
 class SensorData(collections.namedtuple('SensorDataBase', ['temperature', 'humidity'])):
@@ -21,6 +28,10 @@ class SensorData(collections.namedtuple('SensorDataBase', ['temperature', 'humid
 
 
 class Lywsd02Client:
+    # Reconnection delays of stream(), in seconds
+    STREAM_MIN_BACKOFF = 1
+    STREAM_MAX_BACKOFF = 120
+
     UNITS = {
         b'\x01': 'F',
         b'\xff': 'C',
@@ -30,21 +41,29 @@ class Lywsd02Client:
         'F': b'\x01',
     }
 
-    def __init__(self, mac, notification_timeout=5.0):
+    # handle_cache: None for the cache shared on disk, HandleCache() for an in-memory one
+    # peripheral: a disconnected btle.Peripheral to reuse, instead of a new one
+    def __init__(self, mac, notification_timeout=5.0, iface=None, handle_cache=None, peripheral=None):
         self._mac = mac
-        self._peripheral = btle.Peripheral()
+        self._iface = iface
+        self._peripheral = peripheral if peripheral is not None else btle.Peripheral()
         self._notification_timeout = notification_timeout
         self._handles = {}
+        self._handle_cache = HandleCache.shared() if handle_cache is None else handle_cache
+        self._device_handles = None
+        self._firmware = None
         self._tz_offset = None
         self._data = SensorData(None, None)
-        self._history_data = collections.OrderedDict()
+        self._history_data = HistoryBuffer()
         self._context_depth = 0
 
     @contextlib.contextmanager
     def connect(self):
         if self._context_depth == 0:
             _LOGGER.debug('Connecting to %s', self._mac)
-            self._peripheral.connect(self._mac)
+            self._peripheral.connect(self._mac, iface=self._iface)
+            # The handles are validated again on each connection
+            self._device_handles = None
         self._context_depth += 1
         try:
             yield self
@@ -53,6 +72,7 @@ class Lywsd02Client:
             if self._context_depth == 0:
                 _LOGGER.debug('Disconnecting from %s', self._mac)
                 self._peripheral.disconnect()
+                self._handle_cache.save()
 
     @property
     def temperature(self):
@@ -67,12 +87,19 @@ class Lywsd02Client:
         self._get_sensor_data()
         return self._data
 
+    @property
+    def notification_timeout(self):
+        return self._notification_timeout
+
+    def feed_sensor_data(self, data):
+        """Decodes a notification of the data characteristic received without the client, such
+        as through the ble_broker, and returns the sensor data"""
+        self._process_sensor_data(data)
+        return self._data
+
     @property
     def units(self):
-        with self.connect():
-            ch = self._peripheral.getCharacteristics(uuid=UUID_UNITS)[0]
-            value = ch.read()
-        return self.UNITS[value]
+        return self.UNITS[self._read(UUID_UNITS)]
 
     @units.setter
     def units(self, value):
@@ -80,22 +107,21 @@ class Lywsd02Client:
             raise ValueError(
                 'Units value must be one of %s' % self.UNITS_CODES.keys())
 
-        with self.connect():
-            ch = self._peripheral.getCharacteristics(uuid=UUID_UNITS)[0]
-            ch.write(self.UNITS_CODES[value.upper()], withResponse=True)
+        self._write(UUID_UNITS, self.UNITS_CODES[value.upper()])
 
     @property
     def battery(self):
+        return ord(self._read(UUID_BATTERY))
+
+    @property
+    def firmware(self):
         with self.connect():
-            ch = self._peripheral.getCharacteristics(uuid=UUID_BATTERY)[0]
-            value = ch.read()
-        return ord(value)
+            self._get_device_handles()
+            return self._firmware
 
     @property
     def time(self):
-        with self.connect():
-            ch = self._peripheral.getCharacteristics(uuid=UUID_TIME)[0]
-            value = ch.read()
+        value = self._read(UUID_TIME)
         if len(value) == 5:
             ts, tz_offset = struct.unpack('Ib', value)
         else:
@@ -106,9 +132,7 @@ class Lywsd02Client:
     @time.setter
     def time(self, dt: datetime):
         data = struct.pack('Ib', int(dt.timestamp()), self.tz_offset)
-        with self.connect():
-            ch = self._peripheral.getCharacteristics(uuid=UUID_TIME)[0]
-            ch.write(data, withResponse=True)
+        self._write(UUID_TIME, data)
 
     @property
     def tz_offset(self):
@@ -137,6 +161,32 @@ class Lywsd02Client:
                 raise TimeoutError('No data from device for {} seconds'.format(
                     self._notification_timeout))
 
+    def stream(self):
+        """Yields the sensor data each time the device notifies it (every few seconds).
+
+        The connection is held between the readings, and made again with an exponential
+        backoff when it drops. Closing the generator disconnects.
+        """
+        backoff = self.STREAM_MIN_BACKOFF
+        while True:
+            try:
+                with self.connect():
+                    self._subscribe(UUID_DATA, self._process_sensor_data)
+                    while True:
+                        previous = self._data
+                        if not self._peripheral.waitForNotifications(
+                                self._notification_timeout):
+                            raise TimeoutError('No data from device for {} seconds'.format(
+                                self._notification_timeout))
+                        if self._data is not previous:
+                            backoff = self.STREAM_MIN_BACKOFF
+                            yield self._data
+            except (btle.BTLEException, TimeoutError) as e:
+                _LOGGER.warning('Lost %s (%s: %s), reconnecting in %ds',
+                                self._mac, e.__class__.__name__, e, backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.STREAM_MAX_BACKOFF)
+
     def _get_history_data(self):
         with self.connect():
             self._subscribe(UUID_HISTORY, self._process_history_data)
@@ -153,11 +203,61 @@ class Lywsd02Client:
 
     def _subscribe(self, uuid, callback):
         self._peripheral.setDelegate(self)
-        ch = self._peripheral.getCharacteristics(uuid=uuid)[0]
-        self._handles[ch.getHandle()] = callback
-        desc = ch.getDescriptors(forUUID=0x2902)[0]
+        # The descriptor lookup also learns the value handle
+        cccd = self._cccd_handle(uuid)
+        self._handles[self._value_handle(uuid)] = callback
+        self._peripheral.writeCharacteristic(cccd, 0x01.to_bytes(2, byteorder="little"), withResponse=True)
+
+    def _get_device_handles(self):
+        """The handle map of the connected device, checked against its firmware revision"""
+        if self._device_handles is not None:
+            return self._device_handles
+
+        cache = self._handle_cache
+        firmware = None
+        handle = cache.firmware_handle(self._mac)
+        if handle is not None:
+            try:
+                firmware = self._peripheral.readCharacteristic(handle).decode(errors='replace')
+            except btle.BTLEGattError:
+                _LOGGER.debug('Cached handles of %s are stale', self._mac)
+                cache.forget(self._mac)
+        if firmware is None:
+            ch = self._peripheral.getCharacteristics(uuid=UUID_FIRMWARE)[0]
+            cache.set_firmware_handle(self._mac, ch.getHandle())
+            firmware = ch.read().decode(errors='replace')
+
+        self._firmware = firmware
+        self._device_handles = cache.handles(self._mac, firmware)
+        return self._device_handles
+
+    def _value_handle(self, uuid):
+        uuid = uuid.upper()
+        handles = self._get_device_handles()['handles']
+        if uuid not in handles:
+            handle = self._peripheral.getCharacteristics(uuid=uuid)[0].getHandle()
+            self._handle_cache.learn(self._mac, self._firmware, 'handles', uuid, handle)
+            return handle
+        return handles[uuid]
+
+    def _cccd_handle(self, uuid):
+        uuid = uuid.upper()
+        cccds = self._get_device_handles()['cccds']
+        if uuid not in cccds:
+            ch = self._peripheral.getCharacteristics(uuid=uuid)[0]
+            cccd = ch.getDescriptors(forUUID=UUID_CCCD)[0].handle
+            self._handle_cache.learn(self._mac, self._firmware, 'handles', uuid, ch.getHandle())
+            self._handle_cache.learn(self._mac, self._firmware, 'cccds', uuid, cccd)
+            return cccd
+        return cccds[uuid]
+
+    def _read(self, uuid):
+        with self.connect():
+            return self._peripheral.readCharacteristic(self._value_handle(uuid))
 
-        desc.write(0x01.to_bytes(2, byteorder="little"), withResponse=True)
+    def _write(self, uuid, value):
+        with self.connect():
+            self._peripheral.writeCharacteristic(self._value_handle(uuid), value, withResponse=True)
 
     def _process_sensor_data(self, data):
         temperature, humidity = struct.unpack_from('hB', data)
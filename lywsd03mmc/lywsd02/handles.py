@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+import threading
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.getenv('LYWSD02_HANDLE_CACHE', os.path.expanduser('~/.cache/lywsd02/handles.json'))
+
+
+class HandleCache:
+    """GATT handles of the devices, per MAC and firmware version, kept in memory and on disk.
+
+    Reconnecting clients read and write by handle instead of running the characteristic and
+    descriptor discovery again. The handle of the firmware revision is kept per MAC: reading
+    it tells which firmware, hence which handle map, the device has.
+
+    Clients in different threads can share a cache.
+    """
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, path=DEFAULT_PATH):
+        """The cache of a file, shared by all the clients of the process"""
+        with cls._shared_lock:
+            if path not in cls._shared:
+                cls._shared[path] = cls(path)
+            return cls._shared[path]
+
+    def __init__(self, path=None):
+        # path=None: in memory only
+        self._path = path
+        self._devices = None
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    def _load(self):
+        # Called with the lock held
+        if self._devices is not None:
+            return self._devices
+        self._devices = {}
+        if self._path and os.path.exists(self._path):
+            try:
+                with open(self._path) as f:
+                    self._devices = json.load(f)
+            except (OSError, ValueError) as e:
+                _LOGGER.warning('Ignoring the handle cache %s: %s', self._path, e)
+        return self._devices
+
+    def _device(self, mac):
+        return self._load().setdefault(mac.upper(), {'firmware_handle': None, 'firmwares': {}})
+
+    def firmware_handle(self, mac):
+        with self._lock:
+            return self._device(mac)['firmware_handle']
+
+    def set_firmware_handle(self, mac, handle):
+        with self._lock:
+            self._device(mac)['firmware_handle'] = handle
+            self._dirty = True
+
+    def handles(self, mac, firmware):
+        """The handle map of a device and firmware: {'handles': {uuid: value handle}, 'cccds': {uuid: handle}}.
+
+        Read only, the handles are added with learn().
+        """
+        with self._lock:
+            firmwares = self._device(mac)['firmwares']
+            if firmware not in firmwares:
+                firmwares[firmware] = {'handles': {}, 'cccds': {}}
+                self._dirty = True
+            return firmwares[firmware]
+
+    def learn(self, mac, firmware, kind, uuid, handle):
+        """Records a value ('handles') or CCCD ('cccds') handle"""
+        with self._lock:
+            self.handles(mac, firmware)[kind][uuid] = handle
+            self._dirty = True
+
+    def forget(self, mac):
+        with self._lock:
+            self._load().pop(mac.upper(), None)
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty or not self._path:
+                return
+            try:
+                os.makedirs(os.path.dirname(self._path), exist_ok=True)
+                tmp = self._path + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(self._devices, f, indent=1)
+                os.replace(tmp, self._path)
+                self._dirty = False
+            except OSError as e:
+                _LOGGER.warning('Cannot save the handle cache %s: %s', self._path, e)
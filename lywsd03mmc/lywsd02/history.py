@@ -0,0 +1,144 @@
+import bisect
+import collections.abc
+import csv
+from array import array
+from datetime import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Column name -> array typecode
+COLUMNS = collections.OrderedDict([
+    ('idx', 'I'),           # record index of the device
+    ('time', 'q'),          # end of the hour, epoch seconds
+    ('min_temperature', 'h'),   # x 0.01 degree
+    ('min_humidity', 'B'),      # %
+    ('max_temperature', 'h'),   # x 0.01 degree
+    ('max_humidity', 'B'),      # %
+])
+
+TEMPERATURE_COLUMNS = ('min_temperature', 'max_temperature')
+
+
+class HistoryBuffer(collections.abc.Mapping):
+    """History records of a device, in typed columns sorted by record index.
+
+    A record takes 18 bytes instead of a dict entry and a list of Python objects. The buffer
+    still reads like the {idx: [time, min_temp, min_hum, max_temp, max_hum]} mapping the
+    clients used to return, and records are added the same way, with history[idx] = [...].
+    """
+
+    def __init__(self):
+        self._columns = collections.OrderedDict((name, array(code)) for name, code in COLUMNS.items())
+        # Whether the times are in the order of the indexes too, None when unknown. They aren't
+        # after the clock of the device was changed, or the device was reset.
+        self._time_sorted = True
+
+    def __len__(self):
+        return len(self._columns['idx'])
+
+    def __iter__(self):
+        return iter(self._columns['idx'])
+
+    def __repr__(self):
+        return 'HistoryBuffer({} records, {} bytes)'.format(len(self), self.nbytes)
+
+    @property
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in self._columns.values())
+
+    def _position(self, idx):
+        idxs = self._columns['idx']
+        position = bisect.bisect_left(idxs, idx)
+        return position, position < len(idxs) and idxs[position] == idx
+
+    def __getitem__(self, idx):
+        position, found = self._position(idx)
+        if not found:
+            raise KeyError(idx)
+        return self._row(position)
+
+    def __setitem__(self, idx, record):
+        ts, min_temp, min_hum, max_temp, max_hum = record
+        self.append(idx, ts, min_temp, min_hum, max_temp, max_hum)
+
+    def append(self, idx, ts, min_temp, min_hum, max_temp, max_hum):
+        """Adds a record (temperatures in degrees), or replaces the one with the same index"""
+        values = (idx, int(ts.timestamp()), round(min_temp * 100), min_hum, round(max_temp * 100), max_hum)
+        idxs = self._columns['idx']
+        if not idxs or idx > idxs[-1]:
+            # The devices send their records in order
+            if idxs and values[1] < self._columns['time'][-1]:
+                self._time_sorted = False
+            for column, value in zip(self._columns.values(), values):
+                column.append(value)
+            return
+        self._time_sorted = None
+        position, found = self._position(idx)
+        for column, value in zip(self._columns.values(), values):
+            if found:
+                column[position] = value
+            else:
+                column.insert(position, value)
+
+    def _row(self, position):
+        c = self._columns
+        return [datetime.fromtimestamp(c['time'][position]),
+                c['min_temperature'][position] / 100, c['min_humidity'][position],
+                c['max_temperature'][position] / 100, c['max_humidity'][position]]
+
+    def _times_sorted(self):
+        if self._time_sorted is None:
+            times = self._columns['time']
+            self._time_sorted = all(times[i] <= times[i + 1] for i in range(len(times) - 1))
+        return self._time_sorted
+
+    def column(self, name, since=None, until=None):
+        """A column (numpy array if available), restricted to the records of [since, until), in index order"""
+        times = self._columns['time']
+        column = self._columns[name]
+        if since is None and until is None:
+            values = column[:]
+        elif self._times_sorted():
+            start = 0 if since is None else bisect.bisect_left(times, int(since.timestamp()))
+            stop = len(times) if until is None else bisect.bisect_left(times, int(until.timestamp()))
+            values = column[start:stop]
+        else:
+            start = float('-inf') if since is None else int(since.timestamp())
+            stop = float('inf') if until is None else int(until.timestamp())
+            values = array(column.typecode, (value for time, value in zip(times, column) if start <= time < stop))
+        if numpy is not None:
+            return numpy.frombuffer(values, dtype=values.typecode) if len(values) else numpy.array([])
+        return values
+
+    def stats(self, name, since=None, until=None):
+        """min/max/mean of a column over [since, until), None if there is no record; temperatures in degrees"""
+        values = self.column(name, since, until)
+        if not len(values):
+            return None
+        if numpy is not None:
+            result = dict(min=values.min().item(), max=values.max().item(), mean=values.mean().item())
+        else:
+            result = dict(min=min(values), max=max(values), mean=sum(values) / len(values))
+        if name in TEMPERATURE_COLUMNS:
+            result = {key: value / 100 for key, value in result.items()}
+        return result
+
+    def to_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Time', 'Min temperature', 'Min humidity', 'Max temperature', 'Max humidity'])
+            for position in range(len(self)):
+                writer.writerow(self._row(position))
+
+    def to_parquet(self, path):
+        """Needs pyarrow"""
+        import pyarrow
+        import pyarrow.parquet
+
+        types = {'I': pyarrow.uint32(), 'q': pyarrow.int64(), 'h': pyarrow.int16(), 'B': pyarrow.uint8()}
+        table = pyarrow.table(collections.OrderedDict(
+            (name, pyarrow.array(column, type=types[column.typecode])) for name, column in self._columns.items()))
+        pyarrow.parquet.write_table(table, path)
@@ -1,5 +1,9 @@
-from .lywsd03mmc import Lywsd03mmcClient
+from .lywsd03mmc import Lywsd03mmcClient, Snapshot, SNAPSHOT_FIELDS
+from .history_state import HistoryState
 
 __all__ = (
-    'Lywsd03mmcClient'
+    'Lywsd03mmcClient',
+    'Snapshot',
+    'SNAPSHOT_FIELDS',
+    'HistoryState',
 )
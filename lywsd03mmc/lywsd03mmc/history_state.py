@@ -0,0 +1,60 @@
+import json
+import logging
+import os
+from datetime import datetime
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.getenv('LYWSD03MMC_HISTORY_STATE', os.path.expanduser('~/.cache/lywsd03mmc/history.json'))
+
+
+class HistoryState:
+    """Where the history download of each device stopped: last record index and device start time.
+
+    Kept on disk so that the next download, even from another process, resumes after the last
+    record instead of replaying the whole history.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        # path=None: in memory only
+        self._path = path
+        self._devices = None
+
+    def _load(self):
+        if self._devices is not None:
+            return self._devices
+        self._devices = {}
+        if self._path and os.path.exists(self._path):
+            try:
+                with open(self._path) as f:
+                    self._devices = json.load(f)
+            except (OSError, ValueError) as e:
+                _LOGGER.warning('Ignoring the history state %s: %s', self._path, e)
+        return self._devices
+
+    def get(self, mac):
+        """(last index, start time) of the device, or None if its history was never downloaded"""
+        state = self._load().get(mac.upper())
+        if state is None:
+            return None
+        return state['last_idx'], datetime.fromisoformat(state['start_time'])
+
+    def update(self, mac, last_idx, start_time):
+        self._load()[mac.upper()] = {'last_idx': last_idx, 'start_time': start_time.isoformat()}
+        self.save()
+
+    def forget(self, mac):
+        self._load().pop(mac.upper(), None)
+        self.save()
+
+    def save(self):
+        if not self._path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            tmp = self._path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._devices, f, indent=1)
+            os.replace(tmp, self._path)
+        except OSError as e:
+            _LOGGER.warning('Cannot save the history state %s: %s', self._path, e)
@@ -1,14 +1,29 @@
 from lywsd02 import Lywsd02Client
+from lywsd02.client import UUID_DATA, UUID_HARDWARE
+import logging
 import struct
 import collections
 from datetime import datetime, timedelta
 
+_LOGGER = logging.getLogger(__name__)
+
 UUID_HISTORY = 'EBE0CCBC-7A0A-4B0C-8A1A-6FF2997DA3A6'  # Last idx 152          READ NOTIFY
+UUID_RECORD_IDX = 'EBE0CCBA-7A0A-4B0C-8A1A-6FF2997DA3A6'  # uint32 index the history replay starts from   WRITE
+
+# A device start time further than this from the saved one means the device was restarted,
+# and its record indexes started over
+START_TIME_TOLERANCE = timedelta(minutes=10)
 
 # Create a structure to store the data in, which includes battery data
 class SensorDataBattery(collections.namedtuple('SensorDataBase', ['temperature', 'humidity', 'battery', 'voltage'])):
     __slots__ = ()
 
+# Everything a poll of the device can return, see Lywsd03mmcClient.snapshot
+SNAPSHOT_FIELDS = SensorDataBattery._fields + ('firmware', 'hardware', 'time', 'units')
+
+class Snapshot(collections.namedtuple('SnapshotBase', SNAPSHOT_FIELDS)):
+    __slots__ = ()
+
 class Lywsd03mmcClient(Lywsd02Client):
 
     # Temperature units specific to LYWSD03MMC devices
@@ -21,9 +36,12 @@ class Lywsd03mmcClient(Lywsd02Client):
         'C': b'\x00'
     }
 
-    # Call the parent init with a bigger notification timeout
-    def __init__(self, mac, notification_timeout=15.0):
-        super().__init__(mac, notification_timeout)
+    # Call the parent init with a bigger notification timeout.
+    # history_state: a HistoryState to resume the history downloads from, None to download it all
+    def __init__(self, mac, notification_timeout=15.0, iface=None, handle_cache=None, history_state=None,
+                 peripheral=None):
+        super().__init__(mac, notification_timeout, iface, handle_cache, peripheral)
+        self._history_state = history_state
 
     def _process_sensor_data(self, data):
         temperature, humidity, voltage = struct.unpack_from('<hBh', data)
@@ -39,17 +57,58 @@ class Lywsd03mmcClient(Lywsd02Client):
     def battery(self):
         return self.data.battery
 
-    def _get_history_data(self):
-        # Get the time the device was first run
-        self.start_time
+    @property
+    def hardware(self):
+        return self._read(UUID_HARDWARE).decode(errors='replace')
+
+    # Read the requested fields in a single connection.
+    # The subscription to the sensor data is made first, so the device's notification can arrive
+    # while the other characteristics are read. The fields not requested are None.
+    def snapshot(self, fields=SNAPSHOT_FIELDS):
+        unknown = set(fields) - set(SNAPSHOT_FIELDS)
+        if unknown:
+            raise ValueError('Unknown snapshot fields: %s' % ', '.join(sorted(unknown)))
+
+        values = dict.fromkeys(SNAPSHOT_FIELDS)
+        wants_data = any(field in SensorDataBattery._fields for field in fields)
+        with self.connect():
+            previous = self._data
+            if wants_data:
+                self._subscribe(UUID_DATA, self._process_sensor_data)
+            if 'firmware' in fields:
+                values['firmware'] = self.firmware
+            if 'hardware' in fields:
+                values['hardware'] = self.hardware
+            if 'time' in fields:
+                values['time'] = self.time[0]
+                self._start_time = self._start_time_from(values['time'])
+            if 'units' in fields:
+                values['units'] = self.units
+            if wants_data and self._data is previous:
+                if not self._peripheral.waitForNotifications(self._notification_timeout):
+                    raise TimeoutError('No data from device for {} seconds'.format(
+                        self._notification_timeout))
+
+        if wants_data:
+            values.update((field, getattr(self._data, field)) for field in SensorDataBattery._fields
+                          if field in fields)
+        return Snapshot(**values)
 
+    def _get_history_data(self):
         # Work out the expected last record we'll be sent from the device.
         # The current hour doesn't appear until the end of the hour, and the time is recorded as
         # the end of hour time
         expected_end = datetime.now() - timedelta(hours=1)
 
         self._latest_record = False
+        self._last_idx = None
         with self.connect():
+            # Get the time the device was first run
+            self.start_time
+            first_idx = self._resume_index()
+            if first_idx is not None:
+                self._write(UUID_RECORD_IDX, struct.pack('<I', first_idx))
+
             self._subscribe(UUID_HISTORY, self._process_history_data)
 
             while True:
@@ -61,6 +120,26 @@ class Lywsd03mmcClient(Lywsd02Client):
                 if self._latest_record and self._latest_record >= expected_end:
                     break
 
+        if self._history_state is not None and self._last_idx is not None:
+            self._history_state.update(self._mac, self._last_idx, self.start_time)
+
+    # The index to start the history replay from, or None for the whole history.
+    # Keeps the saved start time, so the record times stay the same from one download to the next.
+    def _resume_index(self):
+        if self._history_state is None:
+            return None
+        state = self._history_state.get(self._mac)
+        if state is None:
+            return None
+        last_idx, start_time = state
+        if abs(self.start_time - start_time) > START_TIME_TOLERANCE:
+            _LOGGER.info('%s was restarted, downloading its whole history', self._mac)
+            self._history_state.forget(self._mac)
+            return None
+        self._start_time = start_time
+        _LOGGER.debug('Resuming the history of %s after record %d', self._mac, last_idx)
+        return last_idx + 1
+
     def _process_history_data(self, data):
         (idx, ts, max_temp, max_hum, min_temp, min_hum) = struct.unpack_from('<IIhBhB', data)
 
@@ -70,6 +149,7 @@ class Lywsd03mmcClient(Lywsd02Client):
         max_temp /= 10
 
         self._latest_record = ts
+        self._last_idx = idx if self._last_idx is None else max(self._last_idx, idx)
         self._history_data[idx] = [ts, min_temp, min_hum, max_temp, max_hum]
         self.output_history_progress(ts, min_temp, max_temp)
 
@@ -90,10 +170,13 @@ class Lywsd03mmcClient(Lywsd02Client):
     @property
     def start_time(self):
         if not self._start_time:
-            start_time_delta = self.time[0] - datetime(1970,1,1) - timedelta(hours=self.tz_offset)
-            self._start_time = datetime.now() - start_time_delta
+            self._start_time = self._start_time_from(self.time[0])
         return self._start_time
 
+    def _start_time_from(self, device_time):
+        start_time_delta = device_time - datetime(1970,1,1) - timedelta(hours=self.tz_offset)
+        return datetime.now() - start_time_delta
+
 
     # Disable setting the time and timezone.
     # LYWSD03MMCs don't have visible clocks
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# Polls a fleet of LYWSD03MMC thermometers from a single process, instead of one
+# lywsd03mmc_watcher per device.
+#
+# The connections reuse a pool of --concurrency bluepy Peripherals, so at most --concurrency
+# at a time, which keep their helper process from one connection to the next.
+# A device failing to answer is retried later and later (exponential backoff) instead of in a
+# tight loop, and the adapter is never reset.
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+import logging
+logging.getLogger().setLevel(logging.INFO)
+import os
+import queue
+import threading
+import time
+
+from bluepy import btle
+import lywsd03mmc
+
+DATA_FIELDS = ('temperature', 'humidity', 'battery', 'voltage')
+
+# Retry delays of a failing device, in seconds
+RETRY_MIN = 30
+RETRY_MAX = 3600
+
+
+class Device:
+    """Schedule and statistics of a polled thermometer"""
+
+    def __init__(self, location, mac):
+        self.location = location
+        self.mac = mac
+        self.next_poll = 0
+        self.polling = False
+        self.attempts = 0
+        self.successes = 0
+        self.failures = 0  # consecutive
+        self.connect_latencies = []
+        self.last_error = None
+        self.last_success = None
+
+    def stats(self):
+        latencies = self.connect_latencies
+        return dict(
+            mac=self.mac,
+            attempts=self.attempts,
+            successes=self.successes,
+            success_rate=round(self.successes / self.attempts, 3) if self.attempts else None,
+            consecutive_failures=self.failures,
+            connect_latency_last=round(latencies[-1], 3) if latencies else None,
+            connect_latency_mean=round(sum(latencies) / len(latencies), 3) if latencies else None,
+            last_success=self.last_success,
+            last_error=self.last_error,
+            next_poll_in=round(max(0, self.next_poll - time.monotonic()), 1),
+        )
+
+
+class PooledPeripheral(btle.Peripheral):
+    """A Peripheral keeping its bluepy-helper process between connections.
+
+    btle.Peripheral.disconnect() also stops the helper, so that each connection would start a
+    new one: this one only drops the link (with the commands bluepy itself sends), and close()
+    stops the helper.
+    """
+
+    def disconnect(self):
+        if self._helper is None:
+            return
+        self.setDelegate(None)
+        try:
+            self._writeCmd("disc\n")
+            self._getResp('stat')
+        except (btle.BTLEException, OSError):
+            # The helper is in an unknown state, or dead: the next connection starts a new one
+            self.close()
+
+    def close(self):
+        try:
+            btle.Peripheral.disconnect(self)
+        except (btle.BTLEException, OSError):
+            if self._helper is not None:
+                self._helper.kill()
+                self._helper = None
+
+    def __del__(self):
+        self.close()
+
+
+class Poller:
+
+    # Latencies kept per device for the mean
+    LATENCY_HISTORY = 100
+
+    def __init__(self, devices, interval, concurrency, iface=0, stats_path=None):
+        self.devices = devices
+        self.interval = interval
+        self.iface = iface
+        self.stats_path = stats_path
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._peripherals = queue.Queue()
+        for i in range(concurrency):
+            self._peripherals.put(PooledPeripheral())
+        self._lock = threading.Lock()
+
+    def run(self):
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                due = [device for device in self.devices if not device.polling and device.next_poll <= now]
+                for device in due:
+                    device.polling = True
+            for device in due:
+                self._executor.submit(self._poll, device)
+            time.sleep(1)
+
+    def _poll(self, device):
+        # Blocks while all the connections are in use
+        peripheral = self._peripherals.get()
+        started = time.monotonic()
+        try:
+            client = lywsd03mmc.Lywsd03mmcClient(device.mac, iface=self.iface, peripheral=peripheral)
+            with client.connect():
+                connected = time.monotonic()
+                data = client.snapshot(fields=DATA_FIELDS)
+        except Exception as e:
+            self._failed(device, e)
+        else:
+            self._succeeded(device, data, connected - started)
+        finally:
+            try:
+                peripheral.disconnect()
+            except btle.BTLEException:
+                pass
+            self._peripherals.put(peripheral)
+            with self._lock:
+                device.polling = False
+            self._save_stats()
+
+    def _succeeded(self, device, data, latency):
+        with self._lock:
+            device.attempts += 1
+            device.successes += 1
+            device.failures = 0
+            device.connect_latencies = device.connect_latencies[-(self.LATENCY_HISTORY - 1):] + [latency]
+            device.last_success = str(datetime.now())
+            device.next_poll = time.monotonic() + self.interval
+        logging.info(f"{device.location}: {data} (connected in {latency:.1f}s)")
+
+        output = f"/tmp/{device.location}.json"
+        with open(output, "w") as f:
+            print(json.dumps(dict(
+                temperature = data.temperature,
+                humidity = data.humidity,
+                batt_lvl = data.battery,
+                batt_mv = data.voltage * 1000,
+                date = str(datetime.now()),
+                time = int(datetime.utcnow().timestamp()),
+            ), indent=4), file=f)
+
+    def _failed(self, device, e):
+        with self._lock:
+            device.attempts += 1
+            device.failures += 1
+            device.last_error = f"{e.__class__.__name__}: {e}"
+            delay = min(RETRY_MIN * 2 ** (device.failures - 1), RETRY_MAX)
+            device.next_poll = time.monotonic() + delay
+        logging.warning(f"{device.location}: failed #{device.failures} ({device.last_error}), retrying in {delay}s")
+
+    def stats(self):
+        with self._lock:
+            return {device.location: device.stats() for device in self.devices}
+
+    def _save_stats(self):
+        if not self.stats_path:
+            return
+        # Under the lock, so that the workers don't write over each other, and through a
+        # temporary file, so that the readers never see a partial file
+        with self._lock:
+            stats = {device.location: device.stats() for device in self.devices}
+            temporary = self.stats_path + ".tmp"
+            with open(temporary, "w") as f:
+                json.dump(stats, f, indent=4)
+            os.replace(temporary, self.stats_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Polls several LYWSD03MMC thermometers")
+    parser.add_argument('--target', help='location_MAC of a device (can be repeated)', action='append', required=True)
+    parser.add_argument('--interval', help='seconds between two polls of a device', type=float, default=300)
+    parser.add_argument('--concurrency', help='maximum number of simultaneous connections', type=int, default=2)
+    parser.add_argument('--iface', help='index of the hci adapter to connect with', default=0, type=int)
+    parser.add_argument('--stats', help='file to save the per-device statistics to', default='/tmp/lywsd03mmc_poller.json')
+    args = parser.parse_args()
+
+    devices = [Device(*target.split("_")) for target in args.target]
+    logging.info(f"Polling {len(devices)} devices every {args.interval}s, {args.concurrency} at a time")
+    Poller(devices, args.interval, args.concurrency, args.iface, args.stats).run()
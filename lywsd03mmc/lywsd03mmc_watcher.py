@@ -11,24 +11,75 @@ import sys
 
 import bluepy.btle
 import lywsd03mmc
+from lywsd02.client import UUID_DATA
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--target', help='target', nargs='?', default="jaune_A4:C1:38:63:84:DA")
-parser.add_argument('--tries', help='number of tries', default=3, nargs='?')
+parser.add_argument('--tries', help='number of tries', default=3, type=int, nargs='?')
+parser.add_argument('--broker', help='connect through the ble_broker listening on this socket', nargs='?',
+                    const="/run/ble_broker.sock", metavar="SOCKET")
+parser.add_argument('--iface', help='index of the hci adapter to connect with', default=0, type=int)
+parser.add_argument('--stream', help='stay connected, and save every reading the device notifies', action='store_true')
 args = parser.parse_args()
 
+if args.stream and args.broker:
+    parser.error("--stream holds the connection, it cannot go through the broker")
+
 location, mac = args.target.split("_")
 output = f"/tmp/{location}.json"
 
-logging.info("Restarting the bluetooth hci ...")
-os.system("hciconfig hci0 down && hciconfig hci0 up")
+client = lywsd03mmc.Lywsd03mmcClient(mac, iface=args.iface)
+
+if args.broker:
+    # The broker owns the adapter, resetting it would break the scans of the other collectors
+    sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "ble_broker"))
+    import broker_client
+    broker = broker_client.BrokerClient(f"lywsd03mmc_watcher_{location}", args.broker)
+
+    def read_data():
+        values = broker.notifications(mac, UUID_DATA, timeout=client.notification_timeout)
+        if not values:
+            raise TimeoutError(f"No data from device for {client.notification_timeout} seconds")
+        data = client.feed_sensor_data(values[0])
+        logging.info(f"Waited {broker.queued}s for the radio, connected for {broker.radio}s")
+        return data
+else:
+    logging.info("Restarting the bluetooth hci ...")
+    os.system(f"hciconfig hci{args.iface} down && hciconfig hci{args.iface} up")
+
+    def read_data():
+        return client.snapshot(fields=('temperature', 'humidity', 'battery', 'voltage'))
+
+
+def save(data):
+    json_data = json.dumps(dict(
+        temperature = data.temperature,
+        humidity = data.humidity,
+        batt_lvl = data.battery,
+        batt_mv = data.voltage * 1000,
+        date = str(datetime.now()),
+        time = int(datetime.utcnow().timestamp()),
+    ), indent=4)
+
+    if output != "-":
+        logging.info(f"Saving it to {output} ...")
+        with open(output, "w") as f:
+            print(json_data, file=f)
+    else:
+        print(json_data)
+
 
 logging.info(f"Trying to connect to {mac} ...")
-client = lywsd03mmc.Lywsd03mmcClient(mac)
+
+if args.stream:
+    # The client reconnects on its own, with a backoff
+    for data in client.stream():
+        logging.info(f"Got the data {data} ...")
+        save(data)
 
 for i in range(args.tries):
     try:
-        data = client.data
+        data = read_data()
         break
     except Exception as e:
         logging.warning(f"Try #{i+1}/{args.tries}: failed to connect :/ ({e.__class__.__name__}: {e})")
@@ -38,20 +89,6 @@ else:
     sys.exit(1)
 
 logging.info(f"Got the data {data} ...")
-json_data = json.dumps(dict(
-    temperature = data.temperature,
-    humidity = data.humidity,
-    batt_lvl = data.battery,
-    batt_mv = data.voltage * 1000,
-    date = str(datetime.now()),
-    time = int(datetime.utcnow().timestamp()),
-), indent=4)
-
-
+save(data)
 if output != "-":
-    logging.info(f"Saving it to {output} ...")
-    with open(output, "w") as f:
-        print(json_data, file=f)
     logging.info("All done :)")
-else:
-    print(json_data)
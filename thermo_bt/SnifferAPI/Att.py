@@ -0,0 +1,112 @@
+import logging
+import struct
+
+from .Types import *
+
+LLID_CONTINUATION = 0x1
+LLID_START = 0x2
+LLID_CONTROL = 0x3
+
+L2CAP_HEADER = struct.Struct("<HH")  # length, channel ID
+L2CAP_CID_ATT = 0x0004
+
+ATT_READ_BY_TYPE_RSP = 0x09
+ATT_HANDLE_VALUE_NTF = 0x1B
+ATT_HANDLE_VALUE_IND = 0x1D
+
+BASE_UUID = "0000%04X-0000-1000-8000-00805F9B34FB"
+
+
+def formatUUID(raw):
+    if len(raw) == 2:
+        return BASE_UUID % struct.unpack("<H", raw)[0]
+    h = bytes(reversed(raw)).hex().upper()
+    return "%s-%s-%s-%s-%s" % (h[0:8], h[8:12], h[12:16], h[16:20], h[20:32])
+
+
+class Notification():
+    __slots__ = ("accessAddress", "handle", "uuid", "value", "time")
+
+    def __init__(self, accessAddress, handle, uuid, value, time):
+        self.accessAddress = accessAddress
+        self.handle = handle
+        self.uuid = uuid
+        self.value = value
+        self.time = time
+
+    def __repr__(self):
+        return "ATT notification (handle: 0x%04x, uuid: %s, value: %s)" % (self.handle, self.uuid, self.value.hex())
+
+
+# Reassembles the ATT PDUs of the connections followed by the sniffer, and extracts the
+# GATT notifications and indications.
+#
+# The characteristic value handles are learnt from the characteristic discovery responses
+# (Read By Type) when the client does a discovery; "handles" gives the ones known beforehand,
+# for clients which have cached them.
+class AttDecoder():
+    def __init__(self, handles=None):
+        self.handles = dict(handles or {})  # value handle -> characteristic UUID
+        self._partial = {}  # (access address, direction) -> [L2CAP length, bytearray]
+        self._last = {}     # (access address, direction) -> (SN, LL payload)
+
+    # Returns the list of Notification decoded from this packet.
+    def feed(self, packet):
+        if not packet.OK or packet.blePacket is None or packet.blePacket.type != PACKET_TYPE_DATA:
+            return []
+        if packet.encrypted:
+            return []
+
+        ble = packet.blePacket
+        payload = bytes(ble.payload[:ble.length])
+        key = (tuple(ble.accessAddress), packet.direction)
+
+        # Retransmissions carry the same sequence number and payload
+        if self._last.get(key) == (ble.sn, payload):
+            return []
+        self._last[key] = (ble.sn, payload)
+
+        if not payload or ble.llid == LLID_CONTROL:
+            return []
+
+        if ble.llid == LLID_START:
+            if len(payload) < L2CAP_HEADER.size:
+                return []
+            self._partial[key] = [L2CAP_HEADER.unpack_from(payload)[0] + L2CAP_HEADER.size, bytearray(payload)]
+        elif key in self._partial:
+            self._partial[key][1] += payload
+        else:
+            # Continuation of a fragment we did not see the start of
+            return []
+
+        length, pdu = self._partial[key]
+        if len(pdu) < length:
+            return []
+        del self._partial[key]
+
+        cid = L2CAP_HEADER.unpack_from(pdu)[1]
+        if cid != L2CAP_CID_ATT:
+            return []
+        return self._decodeAtt(key[0], bytes(pdu[L2CAP_HEADER.size:length]), getattr(packet, "time", None))
+
+    def _decodeAtt(self, accessAddress, att, time):
+        opcode = att[0]
+        if opcode in (ATT_HANDLE_VALUE_NTF, ATT_HANDLE_VALUE_IND) and len(att) >= 3:
+            handle = struct.unpack_from("<H", att, 1)[0]
+            return [Notification(accessAddress, handle, self.handles.get(handle), att[3:], time)]
+
+        if opcode == ATT_READ_BY_TYPE_RSP and len(att) >= 2:
+            self._learnHandles(att)
+        return []
+
+    # Characteristic declarations: handle (2), properties (1), value handle (2), UUID (2 or 16)
+    def _learnHandles(self, att):
+        pairLength = att[1]
+        if pairLength not in (7, 21):
+            return
+        for offset in range(2, len(att) - pairLength + 1, pairLength):
+            valueHandle = struct.unpack_from("<H", att, offset + 3)[0]
+            uuid = formatUUID(att[offset + 5:offset + pairLength])
+            if self.handles.get(valueHandle) != uuid:
+                logging.info("GATT characteristic %s on handle 0x%04x" % (uuid, valueHandle))
+                self.handles[valueHandle] = uuid
@@ -10,12 +10,19 @@ from . import Exceptions
 # Lock file management.
 # ref: https://refspecs.linuxfoundation.org/FHS_3.0/fhs/ch05s09.html
 #
-# Stored in /var/lock:
+# Stored in /run/lock (/var/lock links there) when running as root, or else in the runtime
+# directory of the user, since only root can write to /run/lock:
 # The naming convention which must be used is "LCK.." followed by the base name of the device.
 # For example, to lock /dev/ttyS0 the file "LCK..ttyS0" would be created.
 # HDB UUCP lock file format:
 # process identifier (PID) as a ten byte ASCII decimal number, with a trailing newline
 
+if platform == 'linux':
+    LOCK_DIR = '/run/lock' if os.geteuid() == 0 else os.getenv('XDG_RUNTIME_DIR', f'/run/user/{os.getuid()}')
+
+def lockfile_path(port):
+    return os.path.join(LOCK_DIR, f'LCK..{os.path.basename(port)}')
+
 def lockpid(lockfile):
     if (os.path.isfile(lockfile)):
         with open(lockfile) as fd:
@@ -34,8 +41,7 @@ def lock(port):
     if platform != 'linux':
         return
 
-    tty = os.path.basename(port)
-    lockfile = f'/run/user/1000/LCK..{tty}'
+    lockfile = lockfile_path(port)
 
     lockedpid = lockpid(lockfile)
     if lockedpid:
@@ -56,8 +62,7 @@ def unlock(port):
     if platform != 'linux':
         return
 
-    tty = os.path.basename(port)
-    lockfile = f'/var/lock/LCK..{tty}'
+    lockfile = lockfile_path(port)
 
     lockedpid = lockpid(lockfile)
     if lockedpid == os.getpid():
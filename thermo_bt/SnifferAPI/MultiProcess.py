@@ -0,0 +1,228 @@
+import logging
+import multiprocessing
+import os
+import queue
+import struct
+import time
+from multiprocessing import shared_memory
+
+from . import Packet, Exceptions
+from .Types import *
+
+# Size of the frame buffer shared with each worker process
+DEFAULT_RING_SIZE = 1 << 20
+
+RING_HEADER = struct.Struct("<QQ")  # head, tail: total number of bytes written / read
+FRAME_LENGTH = struct.Struct("<H")
+
+
+# Single-producer single-consumer ring buffer of SLIP decoded frames living in shared memory.
+#
+# The producer only ever writes the head counter and the consumer the tail counter, so no lock
+# is needed. A semaphore counts the frames available: it lets the consumer sleep without polling
+# and orders the frame bytes before the head update across processes.
+class FrameRing():
+    def __init__(self, capacity=DEFAULT_RING_SIZE, name=None, available=None):
+        self.capacity = capacity
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=RING_HEADER.size + capacity)
+            RING_HEADER.pack_into(self._shm.buf, 0, 0, 0)
+            self._owner = True
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            self._owner = False
+        self._available = available if available is not None else multiprocessing.Semaphore(0)
+        self._head, self._tail = RING_HEADER.unpack_from(self._shm.buf, 0)
+
+    def __getstate__(self):
+        return {"capacity": self.capacity, "name": self._shm.name, "available": self._available}
+
+    def __setstate__(self, state):
+        self.__init__(state["capacity"], state["name"], state["available"])
+
+    def __repr__(self):
+        return "FrameRing (name: %s, capacity: %d)" % (self._shm.name, self.capacity)
+
+    def _copyIn(self, pos, data):
+        start = RING_HEADER.size + pos % self.capacity
+        first = min(len(data), RING_HEADER.size + self.capacity - start)
+        self._shm.buf[start:start + first] = data[:first]
+        if first < len(data):
+            self._shm.buf[RING_HEADER.size:RING_HEADER.size + len(data) - first] = data[first:]
+
+    def _copyOut(self, pos, length):
+        start = RING_HEADER.size + pos % self.capacity
+        first = min(length, RING_HEADER.size + self.capacity - start)
+        data = bytes(self._shm.buf[start:start + first])
+        if first < length:
+            data += bytes(self._shm.buf[RING_HEADER.size:RING_HEADER.size + length - first])
+        return data
+
+    # Producer side. Returns False, and drops the frame, if the consumer is too far behind.
+    def push(self, frame):
+        size = FRAME_LENGTH.size + len(frame)
+        tail = RING_HEADER.unpack_from(self._shm.buf, 0)[1]
+        if self._head + size - tail > self.capacity:
+            return False
+        self._copyIn(self._head, FRAME_LENGTH.pack(len(frame)))
+        self._copyIn(self._head + FRAME_LENGTH.size, frame)
+        self._head += size
+        struct.pack_into("<Q", self._shm.buf, 0, self._head)
+        self._available.release()
+        return True
+
+    # Consumer side. Returns None if no frame arrived within timeout seconds.
+    def pop(self, timeout=None):
+        if not self._available.acquire(timeout=timeout):
+            return None
+        length = FRAME_LENGTH.unpack(self._copyOut(self._tail, FRAME_LENGTH.size))[0]
+        frame = self._copyOut(self._tail + FRAME_LENGTH.size, length)
+        self._tail += FRAME_LENGTH.size + length
+        struct.pack_into("<Q", self._shm.buf, 8, self._tail)
+        return frame
+
+    def close(self):
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+# UART process: owns the serial port, sends the scan settings and SLIP decodes the frames.
+# BLE packet frames are distributed round-robin over the worker rings.
+def _uartProcess(portnum, baudrate, rings, scanArgs, hopSequence, stopEvent, receivedFrames, droppedFrames):
+    reader = Packet.PacketReader(portnum, baudrate=baudrate)
+    try:
+        if hopSequence:
+            reader.sendHopSequence(hopSequence)
+        reader.sendScan(*scanArgs)
+        reader.sendTK([0])
+
+        nextRing = 0
+        while not stopEvent.is_set():
+            try:
+                frame = reader.decodeFromSLIP(timeout=0.5)
+            except Exceptions.SnifferTimeout:
+                continue
+            if len(frame) <= Packet.ID_POS or frame[Packet.ID_POS] not in (EVENT_PACKET_ADV_PDU, EVENT_PACKET_DATA_PDU):
+                continue
+
+            receivedFrames.value += 1
+            if not rings[nextRing].push(bytes(frame)):
+                droppedFrames.value += 1
+            nextRing = (nextRing + 1) % len(rings)
+    except Exception:
+        logging.exception("UART process error")
+    finally:
+        stopEvent.set()
+        reader.doExit()
+
+
+# Worker process: parses the frames and hands the valid BLE packets to the handler.
+# What the handler returns, unless None, is sent to the parent process.
+def _workerProcess(ring, handler, stopEvent, results):
+    try:
+        while not stopEvent.is_set():
+            frame = ring.pop(timeout=0.5)
+            if frame is None:
+                continue
+            packet = Packet.Packet(list(frame))
+            if not packet.valid or not packet.OK:
+                continue
+            packet.boardId = 0
+            packet.time = time.time()
+            result = handler(packet)
+            if result is not None:
+                results.put(result)
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        logging.exception("worker process error")
+        stopEvent.set()
+    finally:
+        ring.close()
+
+
+# Multi-process variant of the Sniffer scanning mode.
+#
+# One process owns the UART and the SLIP framing, and writes the frames into one shared memory
+# ring per worker. The worker processes parse the packets and call handler(packet), so the
+# packet rate is no longer bound by a single interpreter lock.
+#
+# The frames are spread over the workers regardless of the device, so the workers only decode:
+# handler returns None or a picklable result, and the state (what was already seen, when the
+# capture is done) lives in the parent, in onResult(result), called from wait(). The capture
+# stops when onResult returns True.
+#
+# Only scanning is supported: the firmware responses (version, timestamps) and the device list
+# are not tracked, and packet.time is the host time at which the worker parsed the packet.
+# handler must be picklable, and carry everything it needs rather than read globals set up at
+# run time, when the "spawn" or "forkserver" start methods are used.
+class MultiProcessSniffer():
+    def __init__(self, portnum, baudrate, handler, workers=None, ringSize=DEFAULT_RING_SIZE, onResult=None):
+        self._portnum = portnum
+        self._baudrate = baudrate
+        self._handler = handler
+        self._onResult = onResult
+        self._results = multiprocessing.Queue()
+        self._nWorkers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self._ringSize = ringSize
+        self._stopEvent = multiprocessing.Event()
+        self._receivedFrames = multiprocessing.RawValue("Q", 0)
+        self._droppedFrames = multiprocessing.RawValue("Q", 0)
+        self._rings = []
+        self._processes = []
+
+    def start(self, findScanRsp=False, findAux=False, scanCoded=False, hopSequence=[37, 38, 39]):
+        self._rings = [FrameRing(self._ringSize) for _ in range(self._nWorkers)]
+        for ring in self._rings:
+            self._processes.append(multiprocessing.Process(target=_workerProcess, daemon=True,
+                                                           args=(ring, self._handler, self._stopEvent, self._results)))
+        self._processes.append(multiprocessing.Process(target=_uartProcess, daemon=True,
+                                                       args=(self._portnum, self._baudrate, self._rings,
+                                                             (findScanRsp, findAux, scanCoded), hopSequence,
+                                                             self._stopEvent, self._receivedFrames,
+                                                             self._droppedFrames)))
+        for process in self._processes:
+            process.start()
+        logging.info("multi-process sniffer started with %d workers" % self._nWorkers)
+
+    # Hand the results of the workers to onResult until it asks to stop, the UART process died
+    # or timeout seconds passed. Returns True if the capture is finished.
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._stopEvent.is_set():
+            wait = 0.5 if deadline is None else min(0.5, deadline - time.monotonic())
+            if wait <= 0:
+                break
+            try:
+                result = self._results.get(timeout=wait)
+            except queue.Empty:
+                continue
+            if self._onResult is not None and self._onResult(result):
+                self._stopEvent.set()
+        return self._stopEvent.is_set()
+
+    def doExit(self):
+        self._stopEvent.set()
+        for process in self._processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        for ring in self._rings:
+            ring.close()
+        self._processes = []
+        self._rings = []
+
+    @property
+    def workers(self):
+        return self._nWorkers
+
+    # The number of BLE packet frames read from the UART.
+    @property
+    def receivedFrames(self):
+        return self._receivedFrames.value
+
+    # The number of frames dropped because the workers did not keep up.
+    @property
+    def droppedFrames(self):
+        return self._droppedFrames.value
@@ -34,7 +34,7 @@
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
 # OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from . import UART, Exceptions, Notifications
+from . import UART, Exceptions, Notifications, Pipeline
 import time, logging, os, sys, serial
 from .Types import *
 
@@ -67,11 +67,14 @@ PACKET_COUNTER_CAP = 2**16
 
 
 class PacketReader(Notifications.Notifier):
-    def __init__(self, portnum=None, callbacks=[], baudrate=None):
+    def __init__(self, portnum=None, callbacks=[], baudrate=None, readQueueSize=Pipeline.DEFAULT_READ_QUEUE_SIZE):
         Notifications.Notifier.__init__(self, callbacks)
         self.portnum = portnum
+        self.baudrate = baudrate
+        self.readQueueSize = readQueueSize
+        self.hopSequence = None
         try:
-            self.uart = UART.Uart(portnum, baudrate)
+            self.uart = UART.Uart(portnum, baudrate, readQueueSize)
         except serial.SerialException as e:
             logging.exception("Error opening UART %s" % str(e))
             self.uart = UART.Uart()
@@ -84,9 +87,21 @@ class PacketReader(Notifications.Notifier):
     def setup(self):
         pass
 
+    # Close and open again the UART, with the baud rate it was first opened with.
+    # Raises serial.SerialException while the port is not available, leaving uart None.
+    def reopen(self):
+        if self.uart is not None:
+            self.uart.close()
+        # Not the closed UART, if the new one can't be opened
+        self.uart = None
+        self.uart = UART.Uart(self.portnum, self.baudrate, self.readQueueSize)
+        self.lastReceivedPacket = None
+        self.lastReceivedTimestampPacket = None
+
     def doExit(self):
         # This method will always join the Uart worker thread
-        self.uart.close()
+        if self.uart is not None:
+            self.uart.close()
         # Clear method references to avoid uncollectable cyclic references
         self.clearCallbacks()
 
@@ -297,6 +312,7 @@ class PacketReader(Notifications.Notifier):
                 raise Exceptions.InvalidAdvChannel("%s is not an adv channel" % str(chan))
         payload = [len(hopSequence)] + hopSequence + [37]*(3-len(hopSequence))
         self.sendPacket(SET_ADV_CHANNEL_HOP_SEQ, payload)
+        self.hopSequence = hopSequence
         self.notify("NEW_ADV_HOP_SEQ", {"hopSequence":hopSequence})
 
     def sendVersionReq(self):
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+
+# Default number of packets buffered for a slow consumer before the oldest
+# ones are dropped.
+DEFAULT_STREAM_MAXSIZE = 1000
+
+_END_OF_STREAM = object()
+
+
+# Asynchronous iterator over the packets received by a Sniffer.
+#
+# Packets are pushed from the UART/collector thread into a bounded asyncio
+# queue owned by the event loop the stream was created in. When the consumer
+# does not keep up, the oldest packets are discarded and counted in `dropped`,
+# so memory stays bounded and the newest data is always delivered.
+#
+# Must be created from a coroutine (it binds to the running event loop):
+#
+#     async with sniffer.packets(filter=lambda p: p.OK) as stream:
+#         async for packet in stream:
+#             ...
+class PacketStream():
+    def __init__(self, notifier, filter=None, maxsize=DEFAULT_STREAM_MAXSIZE, key="NEW_BLE_PACKET"):
+        self._loop = asyncio.get_running_loop()
+        # The bound is enforced in _put, so that the end-of-stream marker never evicts a packet.
+        self._queue = asyncio.Queue()
+        self._maxsize = maxsize
+        self._notifier = notifier
+        self._filter = filter
+        self._key = key
+        self._closed = False
+
+        # Packets accepted by the filter, and packets discarded because the queue was full.
+        self.received = 0
+        self.dropped = 0
+
+        notifier.subscribe(key, self._onPacket)
+        notifier.subscribe("APP_EXIT", self._onExit)
+
+    def __repr__(self):
+        return "PacketStream (received: %d, dropped: %d, pending: %d)" % (self.received, self.dropped, self.qsize())
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._notifier.unSubscribe(self._key, self._onPacket)
+        self._notifier.unSubscribe("APP_EXIT", self._onExit)
+        self._post(_END_OF_STREAM)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        packet = await self._queue.get()
+        if packet is _END_OF_STREAM:
+            raise StopAsyncIteration
+        return packet
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    # Called from the collector thread
+    def _onPacket(self, notification):
+        packet = notification.msg["packet"]
+        try:
+            if self._filter is not None and not self._filter(packet):
+                return
+        except Exception:
+            logging.exception("packet stream filter error")
+            return
+        self._post(packet)
+
+    # Called from the collector thread. The sniffer clears its callbacks on
+    # exit, so only the consumer needs to be woken up.
+    def _onExit(self, notification):
+        if not self._closed:
+            self._closed = True
+            self._post(_END_OF_STREAM)
+
+    def _post(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._put, item)
+        except RuntimeError:
+            # The event loop has been closed, nobody is listening anymore.
+            self._closed = True
+
+    # Runs in the event loop
+    def _put(self, item):
+        if item is not _END_OF_STREAM:
+            if self._queue.qsize() >= self._maxsize:
+                self._queue.get_nowait()
+                self.dropped += 1
+            self.received += 1
+        self._queue.put_nowait(item)
@@ -0,0 +1,134 @@
+import collections
+import logging
+import threading
+
+# Overflow policies of a pipeline stage queue
+DROP_OLDEST = "drop-oldest"          # evict the oldest queued item
+DROP_NON_TARGET = "drop-non-target"  # evict the oldest item not matching isTarget, or refuse a non-target item
+BLOCK = "block"                      # block the producer until there is room
+
+POLICIES = (DROP_OLDEST, DROP_NON_TARGET, BLOCK)
+
+DEFAULT_READ_QUEUE_SIZE = 4096  # UART chunks
+DEFAULT_SINK_QUEUE_SIZE = 1000  # notifications
+SINK_DRAIN_TIMEOUT = 10  # seconds a stopping sink may take to handle its queued items
+
+
+# Bounded FIFO connecting two pipeline stages running in different threads.
+class BoundedQueue():
+    def __init__(self, name, maxsize, policy=DROP_OLDEST, isTarget=None):
+        if policy not in POLICIES:
+            raise ValueError("Invalid overflow policy: %s" % str(policy))
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.isTarget = isTarget
+
+        self.dropped = 0
+        self.highWatermark = 0
+
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._notEmpty = threading.Condition(self._lock)
+        self._notFull = threading.Condition(self._lock)
+        self._closed = False
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return "BoundedQueue (%s: %d/%d, dropped: %d)" % (self.name, len(self._items), self.maxsize, self.dropped)
+
+    @property
+    def depth(self):
+        return len(self._items)
+
+    def stats(self):
+        return {"depth": len(self._items), "maxsize": self.maxsize, "highWatermark": self.highWatermark,
+                "dropped": self.dropped, "policy": self.policy}
+
+    # Returns False if the item was dropped, or the queue closed.
+    def put(self, item, timeout=None):
+        with self._lock:
+            if self._closed:
+                return False
+            if len(self._items) >= self.maxsize:
+                if self.policy == BLOCK:
+                    if not self._notFull.wait_for(lambda: self._closed or len(self._items) < self.maxsize, timeout):
+                        self.dropped += 1
+                        return False
+                    if self._closed:
+                        return False
+                elif self.policy == DROP_NON_TARGET and self.isTarget is not None:
+                    if not self.isTarget(item):
+                        self.dropped += 1
+                        return False
+                    self._evictNonTarget()
+                else:
+                    self._items.popleft()
+                    self.dropped += 1
+
+            self._items.append(item)
+            if len(self._items) > self.highWatermark:
+                self.highWatermark = len(self._items)
+            self._notEmpty.notify()
+        return True
+
+    # Returns None on timeout, or once the queue is closed and empty.
+    def get(self, timeout=None):
+        with self._lock:
+            if not self._notEmpty.wait_for(lambda: self._items or self._closed, timeout):
+                return None
+            if not self._items:
+                return None
+            item = self._items.popleft()
+            self._notFull.notify()
+        return item
+
+    # Wake up all the producers and consumers; no more items are accepted.
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._notEmpty.notify_all()
+            self._notFull.notify_all()
+
+    def _evictNonTarget(self):
+        for i, queued in enumerate(self._items):
+            if not self.isTarget(queued):
+                del self._items[i]
+                break
+        else:
+            self._items.popleft()
+        self.dropped += 1
+
+
+# Last stage of the pipeline: runs a slow callback (disk, network) in its own thread, fed by a
+# bounded queue, so it cannot stall the UART collector.
+class Sink(threading.Thread):
+    def __init__(self, name, callback, maxsize=DEFAULT_SINK_QUEUE_SIZE, policy=DROP_OLDEST, isTarget=None):
+        threading.Thread.__init__(self, name="sink-" + name)
+        self.daemon = True
+        self.queue = BoundedQueue(name, maxsize, policy, isTarget)
+        self.callback = callback
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def run(self):
+        # get() only returns None once the queue is closed and drained
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.callback(item)
+            except Exception:
+                logging.exception("%s sink error" % self.queue.name)
+
+    # Refuse new items, and wait for the queued ones to be handled: they are only dropped on overload.
+    def stop(self, timeout=SINK_DRAIN_TIMEOUT):
+        self.queue.close()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+            if self.is_alive():
+                logging.warning("%s sink still has %d items after %ds, dropping them" % (self.queue.name, len(self.queue), timeout))
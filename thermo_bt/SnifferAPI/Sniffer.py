@@ -57,7 +57,7 @@ initLog()
 
 
 import sys, os, threading
-from . import SnifferCollector
+from . import SnifferCollector, PacketStream, Pipeline
 
 class Sniffer(threading.Thread, SnifferCollector.SnifferCollector):
 
@@ -80,6 +80,25 @@ class Sniffer(threading.Thread, SnifferCollector.SnifferCollector):
     def getPackets(self, number=-1):
         return self._getPackets(number)
 
+    # Get an asynchronous iterator over the new BLE packets. Must be called from a coroutine.
+    # "filter" is an optional callable evaluated in the sniffer thread; only packets for which
+    # it returns True are queued. At most "maxsize" packets are buffered, older ones are dropped
+    # and counted in the stream "dropped" attribute.
+    # Example: async for packet in sniffer.packets(filter=lambda p: p.OK): ...
+    # Returns: A PacketStream object.
+    def packets(self, filter=None, maxsize=PacketStream.DEFAULT_STREAM_MAXSIZE):
+        return PacketStream.PacketStream(self, filter, maxsize)
+
+    # Subscribe a slow callback (disk or network I/O) to the notifications of "key".
+    # The callback runs in its own thread, fed by a queue of at most "maxsize" notifications,
+    # so it cannot stall the UART collector. "policy" is the overflow policy of the queue:
+    # Pipeline.DROP_OLDEST, Pipeline.BLOCK or Pipeline.DROP_NON_TARGET (with "isTarget",
+    # a predicate on the notifications to keep).
+    # Returns: A Pipeline.Sink object.
+    def subscribeSink(self, key, callback, name=None, maxsize=Pipeline.DEFAULT_SINK_QUEUE_SIZE,
+                      policy=Pipeline.DROP_OLDEST, isTarget=None):
+        return self._addSink(key, callback, name, maxsize, policy, isTarget)
+
     # Get a list of devices which are advertising in range of the Sniffer.
     # Returns: A DeviceList object.
     def getDevices(self):
@@ -190,6 +209,27 @@ class Sniffer(threading.Thread, SnifferCollector.SnifferCollector):
     def inConnection(self):
         return self._inConnection
 
+    # The depth, bound and drop counters of the pipeline queues: the UART "read" stage,
+    # the "capture" file sink, and the sinks added with subscribeSink.
+    @property
+    def pipelineStats(self):
+        return self._pipelineStats()
+
+    # The error which stopped the sniffer from reopening the UART, None while it can reconnect.
+    @property
+    def reconnectError(self):
+        return self._reconnectError
+
+    # The number of times the UART was lost and reopened without restarting the sniffer.
+    @property
+    def reconnectCount(self):
+        return self._reconnects
+
+    # A Histogram of the time (in seconds) spent without the sniffer hardware, per reconnection.
+    @property
+    def reconnectDowntime(self):
+        return self._reconnectDowntime
+
     # The internal state of the sniffer. States are defined in SnifferCollector module. Valid values are 0-2.
     @property
     def state(self):
@@ -34,7 +34,7 @@
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
 # OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from . import Packet, Exceptions, CaptureFiles, Devices, Notifications
+from . import Packet, Exceptions, CaptureFiles, Devices, Notifications, Pipeline
 import time, sys, threading, subprocess, os, logging, copy
 from serial import SerialException
 from .Types import *
@@ -43,6 +43,40 @@ STATE_INITIALIZING = 0
 STATE_SCANNING = 1
 STATE_FOLLOWING = 2
 
+# Delay between two attempts to reopen a lost UART, doubled after each failure
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+
+DOWNTIME_BUCKETS = [1, 2, 5, 10, 30, 60, 120, 300, float("inf")]
+
+
+class Histogram():
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def __repr__(self):
+        return "Histogram (count: %d, sum: %.1f, buckets: %s)" % (self.count, self.sum, self.asDict())
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    # Cumulative counts, as Prometheus histograms
+    def asDict(self):
+        total = 0
+        cumulative = {}
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative[bound] = total
+        return cumulative
+
 class SnifferCollector(Notifications.Notifier):
     def __init__(self, portnum=None, baudrate=None, *args, **kwargs):
         Notifications.Notifier.__init__(self, *args, **kwargs)
@@ -50,6 +84,10 @@ class SnifferCollector(Notifications.Notifier):
         self._fwversion = "Unknown version"
         self._setState(STATE_INITIALIZING)
         self._captureHandler = CaptureFiles.CaptureFileHandler(capture_file_path=kwargs.get("capture_file_path", None))
+        # Capture file writes are disk I/O, keep them out of the UART collector thread
+        self._captureSink = Pipeline.Sink("capture", self._captureHandler.writePacket)
+        self._captureSink.start()
+        self._sinks = [self._captureSink]
         self._exit = False
         self._connectionAccessAddress = None
         self._packetListLock = threading.RLock()
@@ -57,7 +95,8 @@ class SnifferCollector(Notifications.Notifier):
             self._packets = []
 
         self._packetReader = Packet.PacketReader(self._portnum, baudrate=baudrate,
-                                                 callbacks=[("*", self.passOnNotification)])
+                                                 callbacks=[("*", self.passOnNotification)],
+                                                 readQueueSize=kwargs.get("read_queue_size", Pipeline.DEFAULT_READ_QUEUE_SIZE))
         self._devices = Devices.DeviceList(callbacks=[("*", self.passOnNotification)])
 
         self._missedPackets = 0
@@ -76,6 +115,15 @@ class SnifferCollector(Notifications.Notifier):
         self._last_timestamp = 0
         self._boardId = self._makeBoardId()
 
+        # Reopen the UART when the sniffer is lost, instead of exiting
+        self._reconnectEnabled = kwargs.get("reconnect", True)
+        self._reconnects = 0
+        # Set when the UART could not be reopened for a reason waiting won't fix
+        self._reconnectError = None
+        self._reconnectDowntime = Histogram(DOWNTIME_BUCKETS)
+        self._scanArgs = None
+        self._followArgs = None
+
     def __del__(self):
         self._doExit()
 
@@ -144,7 +192,7 @@ class SnifferCollector(Notifications.Notifier):
         self._appendPacket(packet)
 
         self.notify("NEW_BLE_PACKET", {"packet": packet})
-        self._captureHandler.writePacket(packet)
+        self._captureSink.put(packet)
 
         self._nProcessedPackets += 1
         if packet.OK:
@@ -183,7 +231,10 @@ class SnifferCollector(Notifications.Notifier):
             except (SerialException, ValueError):
                 logging.exception("UART read error")
                 logging.error("Lost contact with sniffer hardware.")
-                self._doExit()
+                if self._reconnectEnabled and not self._exit:
+                    self._reconnect()
+                else:
+                    self._doExit()
             except Exceptions.InvalidPacketException:
                 pass
             else:
@@ -238,8 +289,55 @@ class SnifferCollector(Notifications.Notifier):
                     return self._packets[i]
         return None
 
+    def _reconnect(self):
+        lostAt = time.time()
+        delay = RECONNECT_MIN_DELAY
+        while not self._exit:
+            try:
+                self._packetReader.reopen()
+                break
+            except (SerialException, OSError, Exceptions.LockedException) as e:
+                logging.info("Sniffer not available (%s), retrying in %d seconds" % (str(e), delay))
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            except Exception as e:
+                # Such as an invalid baud rate, which no retry would fix
+                logging.exception("Could not reopen the sniffer, giving up")
+                self._reconnectError = e
+                self.notify("RECONNECT_FAILED", {"errorString": str(e)})
+                self._doExit()
+                return
+        if self._exit:
+            return
+
+        self._restoreSettings()
+
+        downtime = time.time() - lostAt
+        self._reconnects += 1
+        self._reconnectDowntime.observe(downtime)
+        logging.info("Reconnected to the sniffer after %.1f seconds (reconnection #%d)" % (downtime, self._reconnects))
+        self.notify("RECONNECTED", {"downtime": downtime, "reconnects": self._reconnects})
+
+    # Send again the settings the firmware lost when the sniffer was reset
+    def _restoreSettings(self):
+        self._inConnection = False
+        # Use host timestamps until the firmware timestamp reference is received again
+        self._last_time = None
+        self._packetReader.sendTimestampReq()
+
+        if self._packetReader.hopSequence:
+            self._packetReader.sendHopSequence(self._packetReader.hopSequence)
+
+        if self.state == STATE_FOLLOWING and self._followArgs is not None:
+            device, followOnlyAdvertisements, followOnlyLegacy, followCoded = self._followArgs
+            self._packetReader.sendFollow(device.address, followOnlyAdvertisements, followOnlyLegacy, followCoded)
+        elif self.state == STATE_SCANNING and self._scanArgs is not None:
+            self._packetReader.sendScan(*self._scanArgs)
+            self._packetReader.sendTK([0])
+
     def _startScanning(self, findScanRsp = False, findAux = False, scanCoded = False):
         logging.info("starting scan")
+        self._scanArgs = (findScanRsp, findAux, scanCoded)
 
         if self.state == STATE_FOLLOWING:
             logging.info("Stopped sniffing device")
@@ -248,9 +346,29 @@ class SnifferCollector(Notifications.Notifier):
         self._packetReader.sendScan(findScanRsp, findAux, scanCoded)
         self._packetReader.sendTK([0])
 
+    def _addSink(self, key, callback, name=None, maxsize=Pipeline.DEFAULT_SINK_QUEUE_SIZE,
+                 policy=Pipeline.DROP_OLDEST, isTarget=None):
+        sink = Pipeline.Sink(name or getattr(callback, "__name__", "sink"), callback, maxsize, policy, isTarget)
+        sink.start()
+        self._sinks.append(sink)
+        self.subscribe(key, sink.put)
+        return sink
+
+    def _pipelineStats(self):
+        stats = {}
+        # No UART while a reconnection is failing
+        uart = self._packetReader.uart
+        if uart is not None:
+            stats["read"] = uart.read_queue.stats()
+        for sink in self._sinks:
+            stats[sink.queue.name] = sink.queue.stats()
+        return stats
+
     def _doExit(self):
         self._exit = True
         self.notify("APP_EXIT")
+        for sink in self._sinks:
+            sink.stop()
         self._packetReader.doExit()
         # Clear method references to avoid uncollectable cyclic references
         self.clearCallbacks()
@@ -260,6 +378,7 @@ class SnifferCollector(Notifications.Notifier):
         self._devices.setFollowed(device)
         logging.info("Sniffing device " + str(self._devices.index(device)) + ' - "'+device.name+'"')
         self._packetReader.sendFollow(device.address, followOnlyAdvertisements, followOnlyLegacy, followCoded)
+        self._followArgs = (device, followOnlyAdvertisements, followOnlyLegacy, followCoded)
         self._setState(STATE_FOLLOWING)
 
     def _clearDevices(self):
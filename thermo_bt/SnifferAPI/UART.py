@@ -34,16 +34,16 @@
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
 # OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import collections
 import logging
 import serial
-from threading import Thread, Event
+from threading import Thread
 
 import serial.tools.list_ports as list_ports
 
 from . import Exceptions
 from . import Packet
 from . import Filelock
+from . import Pipeline
 
 import os
 if os.name == "posix":
@@ -109,15 +109,15 @@ def find_sniffer_baudrates(port, write_data=False):
 
 
 class Uart:
-    def __init__(self, portnum=None, baudrate=None):
+    def __init__(self, portnum=None, baudrate=None, queueSize=Pipeline.DEFAULT_READ_QUEUE_SIZE):
         self.ser = None
+        self.portnum = portnum
         try:
             if baudrate is not None and baudrate not in SNIFFER_BAUDRATES:
                 raise Exception("Invalid baudrate: " + str(baudrate))
 
             logging.info('Opening serial port {}'.format(portnum))
 
-            self.portnum = portnum
             if self.portnum:
                 Filelock.lock(portnum)
 
@@ -133,10 +133,19 @@ class Uart:
             if self.ser:
                 self.ser.close()
                 self.ser = None
+            # Don't keep the port locked, it would be refused to the next attempt
+            if self.portnum:
+                Filelock.unlock(self.portnum)
             raise
 
-        self.read_queue = collections.deque()
-        self.read_queue_has_data = Event()
+        # Read stage of the sniffer pipeline: chunks of bytes, as returned by the serial port.
+        # Always blocking: dropping a chunk would cut the SLIP frames around it, the drop policies
+        # only apply to whole packets, further down the pipeline.
+        self.read_queue = Pipeline.BoundedQueue("read", queueSize, Pipeline.BLOCK)
+        self._chunk = b""
+        self._chunkPos = 0
+        # Set when the reader thread lost the port, raised to the reading side
+        self.readError = None
 
         self.worker_thread = Thread(target=self._read_worker)
         self.reading = True
@@ -153,7 +162,9 @@ class Uart:
                 self._read_queue_extend(data_read)
             except serial.SerialException as e:
                 logging.info("Unable to read UART: %s" % e)
+                self.readError = e
                 self.reading = False
+                self.read_queue.close()
                 return
 
     def close(self):
@@ -161,7 +172,7 @@ class Uart:
             logging.info("closing UART")
             self.reading = False
             # Wake any threads waiting on the queue
-            self.read_queue_has_data.set()
+            self.read_queue.close()
             if hasattr(self.ser, "cancel_read"):
                 self.ser.cancel_read()
                 self.worker_thread.join()
@@ -196,20 +207,20 @@ class Uart:
 
     def _read_queue_extend(self, data):
         if len(data) > 0:
-            self.read_queue.extend(data)
-            self.read_queue_has_data.set()
+            self.read_queue.put(data)
 
     def _read_queue_get(self, timeout=None):
-        data = None
-        if self.read_queue_has_data.wait(timeout):
-            self.read_queue_has_data.clear()
-            try:
-                data = self.read_queue.popleft()
-            except IndexError:
-                # This will happen when the class is destroyed
+        if self._chunkPos >= len(self._chunk):
+            chunk = self.read_queue.get(timeout)
+            if chunk is None:
+                if self.readError is not None:
+                    raise self.readError
+                # Timeout, or the class is destroyed
                 return None
-            if len(self.read_queue) > 0:
-                self.read_queue_has_data.set()
+            self._chunk = chunk
+            self._chunkPos = 0
+        data = self._chunk[self._chunkPos]
+        self._chunkPos += 1
         return data
 
 
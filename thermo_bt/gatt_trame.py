@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# Decoding of the LYWSD03MMC GATT notifications captured in follow mode,
+# see lywsd03mmc/lywsd03mmc/lywsd03mmc.py for the client side.
+
+import struct
+
+UUID_HISTORY = 'EBE0CCBC-7A0A-4B0C-8A1A-6FF2997DA3A6'
+UUID_DATA = 'EBE0CCC1-7A0A-4B0C-8A1A-6FF2997DA3A6'
+
+# Value handles of the stock firmware, for the clients which skip the discovery
+KNOWN_HANDLES = {
+    0x0036: UUID_DATA,
+}
+
+"""
+UUID_DATA:
+int16_t     temperature;    // x 0.01 degree
+uint8_t     humidity;       // %
+uint16_t    battery_mv;     // mV
+
+UUID_HISTORY:
+uint32_t    idx;
+uint32_t    ts;             // seconds since the device start
+int16_t     max_temperature;    // x 0.1 degree
+uint8_t     max_humidity;
+int16_t     min_temperature;    // x 0.1 degree
+uint8_t     min_humidity;
+"""
+
+DATA = struct.Struct('<hBH')
+HISTORY = struct.Struct('<IIhBhB')
+
+
+def decode_data(value):
+    temperature, humidity, batt_mv = DATA.unpack_from(value)
+    return dict(
+        temperature=temperature / 100,
+        humidity=humidity,
+        batt_mv=batt_mv,
+        # 3.1V or above --> 100%, 2.1V --> 0%
+        batt_lvl=max(0, min(int(round(batt_mv / 1000 - 2.1, 2) * 100), 100)),
+    )
+
+
+def decode_history(value):
+    idx, ts, max_temp, max_hum, min_temp, min_hum = HISTORY.unpack_from(value)
+    return dict(
+        idx=idx,
+        device_time=ts,
+        min_temperature=min_temp / 10,
+        min_humidity=min_hum,
+        max_temperature=max_temp / 10,
+        max_humidity=max_hum,
+    )
+
+
+def decode(notification):
+    """Returns ("data"|"history", values) for the notifications of the thermometer, or None"""
+    if notification.uuid == UUID_DATA and len(notification.value) >= DATA.size:
+        return "data", decode_data(notification.value)
+    if notification.uuid == UUID_HISTORY and len(notification.value) >= HISTORY.size:
+        return "history", decode_history(notification.value)
+    return None
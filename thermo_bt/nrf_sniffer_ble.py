@@ -42,6 +42,7 @@ Wireshark extcap wrapper for the nRF Sniffer for Bluetooth LE by Nordic Semicond
 """
 
 import datetime
+import functools
 import threading
 import json
 import os
@@ -56,9 +57,10 @@ logging.info("")
 
 import serial
 
-from SnifferAPI import Sniffer, UART, Devices, Pcap, Exceptions
+from SnifferAPI import Sniffer, UART, Devices, Pcap, Exceptions, MultiProcess, Pipeline, Att, Types
 
 import trame
+import gatt_trame
 
 ERROR_USAGE = 0
 ERROR_ARG = 1
@@ -176,6 +178,54 @@ def new_packet(notification):
     handle_packet(p)
     #capture_write(Pcap.create_packet(p, packet.time))
 
+def follow_packet(notification):
+    """A new Bluetooth LE packet of the followed device has arrived"""
+    if not write_new_packets:
+        return
+
+    packet = notification.msg["packet"]
+    if packet.blePacket is None:
+        return
+
+    if packet.blePacket.type == Types.PACKET_TYPE_ADVERTISING:
+        decode_packet(bytes([packet.boardId] + packet.getList()), remove_found=False)
+        return
+
+    for att_notification in att_decoder.feed(packet):
+        try:
+            decoded = gatt_trame.decode(att_notification)
+        except Exception as e:
+            logging.error(f"Could no decode the notification ... {e.__class__.__name__}: {e}")
+            continue
+        if decoded is None:
+            continue
+
+        kind, data = decoded
+        if kind == "data":
+            save_data(follow_location, data)
+        else:
+            save_history(follow_location, data)
+
+
+def address_filter(address):
+    """Make the mac filter representation of the address"""
+    return "".join(format(b, "02x") for b in reversed(address[:6]))
+
+
+def is_target_packet(notification):
+    """Check if the packet was advertised by one of the watched devices, or is part of the followed connection"""
+    ble_packet = notification.msg["packet"].blePacket
+    if ble_packet is None:
+        return False
+    if ble_packet.type == Types.PACKET_TYPE_DATA:
+        return True
+
+    address = getattr(ble_packet, "advAddress", None)
+    if not address:
+        return False
+
+    return address_filter(address) in target_filters
+
 ctrl = threading.Event()
 finished = False
 
@@ -185,12 +235,66 @@ mac_addresses = {
 }
 
 mac_filters = {}
+# The filters of the devices still watched, replaced as a whole when one is removed: read from
+# the UART collector thread while the sink thread removes the found devices from mac_filters
+target_filters = frozenset()
+
+# In follow mode, the sniffer follows this device into its connections
+follow_location = None
+follow_sniffer = None
+att_decoder = Att.AttDecoder(gatt_trame.KNOWN_HANDLES)
 
 def handle_packet(p):
+    if not decode_packet(p):
+        return
+
+    logging.info("all done")
+    global finished
+    finished = True
+    ctrl.set()
+
+    while True:
+        time.sleep(1)
+
+
+def sniffer_failed(notification):
+    """The sniffer was lost and can't be reopened"""
+    logging.critical(f"Sniffer lost for good: {notification.msg['errorString']}")
+    global finished
+    finished = True
+    ctrl.set()
+
+
+def worker_packet(filters, rssi_filter, packet):
+    """A new Bluetooth LE packet has been parsed by a worker process: returns its readings, or None.
+
+    The workers get the filters as an argument, and don't change them: the same device is seen by
+    all the workers, only the parent knows which devices are done.
+    """
+    if not(rssi_filter == 0 or packet.RSSI > rssi_filter):
+        return None
+
+    return decode_readings(filters, bytes([packet.boardId] + packet.getList())) or None
+
+
+def worker_readings(readings):
+    """Save the readings decoded by a worker process, returns True when all the watched devices are done"""
+    for location, data in readings:
+        # Several workers may decode the adverts of a device before it is removed
+        if location not in mac_filters:
+            continue
+        save_data(location, data)
+        stop_watching([location])
+
+    return not mac_filters
+
+
+def decode_readings(filters, p):
+    """Decode the readings of the watched devices ({location: mac filter}) in a packet: [(location, data)]"""
     hex_repr = "".join([m for m in map("{:x}".format, p)]).replace("0x", "")
 
-    found = []
-    for location, mac_filter in mac_filters.items():
+    readings = []
+    for location, mac_filter in filters.items():
         if mac_filter not in hex_repr:
             continue
         try:
@@ -200,28 +304,46 @@ def handle_packet(p):
           logging.error(f"Could no decode the trame ... {e.__class__.__name__}: {e}")
           continue
 
-        data["date"] = str(datetime.datetime.now())
-        data["time"] = int(datetime.datetime.utcnow().timestamp())
+        readings.append((location, data))
+    return readings
+
+
+def decode_packet(p, remove_found=True):
+    """Decode and save the readings of the watched devices, returns True when all of them are done"""
+    found = []
+    for location, data in decode_readings(mac_filters, p):
         found.append(location)
-        dest = f"/tmp/{location}.json"
-        logging.info(f"Saving {dest} ...")
-        with open(dest, "w") as f:
-            json.dump(data, f, indent=4)
+        save_data(location, data)
+
+    if not found or not remove_found: return False
+    stop_watching(found)
 
-    if not found: return
-    for location in found:
+    return not mac_filters
+
+
+def stop_watching(locations):
+    """Stop watching the devices at these locations"""
+    global target_filters
+    for location in locations:
         del mac_filters[location]
+    target_filters = frozenset(mac_filters.values())
 
-    if not mac_filters:
-        logging.info("all done")
-        global finished
-        finished = True
-        ctrl.set()
 
-        while True:
-            time.sleep(1)
+def save_data(location, data):
+    data["date"] = str(datetime.datetime.now())
+    data["time"] = int(datetime.datetime.utcnow().timestamp())
+    dest = f"/tmp/{location}.json"
+    logging.info(f"Saving {dest} ...")
+    with open(dest, "w") as f:
+        json.dump(data, f, indent=4)
 
-    pass
+
+def save_history(location, record):
+    record["time"] = int(datetime.datetime.utcnow().timestamp())
+    dest = f"/tmp/{location}_history.jsonl"
+    logging.info(f"Appending history record #{record['idx']} to {dest} ...")
+    with open(dest, "a") as f:
+        print(json.dumps(record), file=f)
 
 def device_added(notification):
     """A device is added or updated"""
@@ -239,6 +361,11 @@ def device_added(notification):
                string_address(device.address))
 
     message = str(device.address) + '\0' + display
+
+    if (follow_sniffer is not None and not device.followed
+            and address_filter(device.address) == mac_filters.get(follow_location)):
+        logging.info(f"Following '{follow_location}' {string_address(device.address)}")
+        follow_sniffer.follow(device)
     #print("ctrl: device_added", message)
     #control_write(CTRL_ARG_DEVICE, CTRL_CMD_ADD, message)
 
@@ -296,7 +423,7 @@ def get_default_baudrate(interface):
 
 def sniffer_capture(interface, baudrate):
     """Start the sniffer to capture packets"""
-    global write_new_packets
+    global write_new_packets, follow_sniffer
 
     try:
         logging.info("Log started at %s", time.strftime("%c"))
@@ -306,11 +433,17 @@ def sniffer_capture(interface, baudrate):
             baudrate = get_default_baudrate(interface)
 
         sniffer = Sniffer.Sniffer(interface, baudrate)
-        sniffer.subscribe("NEW_BLE_PACKET", new_packet)
+        # The packets are decoded and saved out of the UART thread. When it falls behind,
+        # the packets of the other devices are dropped first.
+        sniffer.subscribeSink("NEW_BLE_PACKET", follow_packet if in_follow_mode else new_packet,
+                              policy=Pipeline.DROP_NON_TARGET, isTarget=is_target_packet)
+        if in_follow_mode:
+            follow_sniffer = sniffer
         sniffer.subscribe("DEVICE_ADDED", device_added)
         sniffer.subscribe("DEVICE_UPDATED", device_added)
         sniffer.subscribe("DEVICE_REMOVED", device_removed)
         sniffer.subscribe("DEVICES_CLEARED", devices_cleared)
+        sniffer.subscribe("RECONNECT_FAILED", sniffer_failed)
         sniffer.setAdvHopSequence([37, 38, 39])
         #sniffer.setSupportedProtocolVersion(get_supported_protocol_version(extcap_version))
         logging.info("Sniffer created")
@@ -330,6 +463,8 @@ def sniffer_capture(interface, baudrate):
             # Wait for keyboardinterrupt
             ctrl.wait()
         logging.info("bye bye :)")
+        logging.info(f"Pipeline: {sniffer.pipelineStats}")
+        logging.info(f"Reconnections: {sniffer.reconnectCount}, downtime: {sniffer.reconnectDowntime}")
 
     except Exceptions.LockedException as e:
         logging.info('{}'.format(e.message))
@@ -341,6 +476,26 @@ def sniffer_capture(interface, baudrate):
         logging.info("Exiting")
 
 
+def sniffer_capture_multiprocess(interface, baudrate, workers):
+    """Start the sniffer with the UART decoding and the packet parsing in separate processes"""
+    validate_interface(interface)
+    if baudrate is None:
+        baudrate = get_default_baudrate(interface)
+
+    # The workers get a copy of the filters: with the spawn start method they don't inherit the globals
+    handler = functools.partial(worker_packet, dict(mac_filters), rssi_filter)
+    sniffer = MultiProcess.MultiProcessSniffer(interface, baudrate, handler, workers=workers,
+                                               onResult=worker_readings)
+    try:
+        sniffer.start(capture_scan_response, capture_scan_aux_pointer, capture_coded)
+        logging.info("scanning started")
+        sniffer.wait()
+        logging.info("bye bye :)")
+    finally:
+        logging.info(f"Received {sniffer.receivedFrames} frames, dropped {sniffer.droppedFrames}")
+        sniffer.doExit()
+
+
 import atexit
 
 @atexit.register
@@ -375,6 +530,10 @@ if __name__ == '__main__':
     parser.add_argument("--scan-follow-rsp", help="Find scan response data ", action="store_true")
     parser.add_argument("--scan-follow-aux", help="Find auxiliary pointer data", action="store_true")
     parser.add_argument("--coded", help="Scan and follow on LE Coded PHY", action="store_true")
+    parser.add_argument("--follow", action="store_true",
+                        help="Follow the target into its connections and capture its GATT notifications")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Parse the packets in WORKERS processes, 0 to run in a single process")
 
     logging.info("Started PID {}".format(os.getpid()))
 
@@ -408,6 +567,14 @@ if __name__ == '__main__':
 
     for name, mac in mac_filters.items():
         logging.info(f"Watching for '{name}' --> {mac}")
+    target_filters = frozenset(mac_filters.values())
+
+    if args.follow:
+        if len(mac_filters) != 1 or args.workers:
+            logging.critical("--follow needs a single target, in a single process")
+            exit(1)
+        in_follow_mode = True
+        follow_location = next(iter(mac_filters))
 
     interface = args.device
 
@@ -419,7 +586,10 @@ if __name__ == '__main__':
 
     try:
         logging.info('sniffer capture')
-        sniffer_capture(interface, args.baudrate)
+        if args.workers > 0:
+            sniffer_capture_multiprocess(interface, args.baudrate, args.workers)
+        else:
+            sniffer_capture(interface, args.baudrate)
     except KeyboardInterrupt:
         pass
     except Exception as e: